@@ -1,21 +1,25 @@
+import copy
 import csv
-from lib import models, gnomad, decipher, dbvar, utils, Interval_base, Types
-from lib.patient import Patient, SV
+import time
+from lib import models, utils, carriers, clusters, bulk_load, ledger, annotation, annotation_cache, gtf, pipeline, Interval_base, Interval_array, Types
+from lib.patient import Patient, SV, Parse_pool, Cohort, Filter_set, records_to_SVs
 import sqlalchemy as sa
 from sqlalchemy.orm import Session
-from typing import List
-import pysam
+from typing import Dict, Iterator, List, Tuple
+import numpy as np
 import yaml
 
-CHROMOSOMES = [str(i) for i in range(23)] + ['X', 'Y']
-CHROMOSOMES += [f"chr{i}" for i in CHROMOSOMES]
-CHROMOSOMES = set(CHROMOSOMES)
+# groups from this size on are swept (see get_duplicates), smaller ones compared pairwise
+DUPLICATES_SWEEP_SIZE = 32
+
 # Note that if FILTER is None, it is PASS (weird thing from cyvcf2)
 def get_duplicates(SVs, distance_cutoff):
     # mark duplicate on filtered, canvas call
     # since Canvas call tends to overestimate size
     bad_svs = set()
     SVs.sort(key=lambda x: (x.FILTER!='PASS', x.source == 'canvas'))
+    if len(SVs) >= DUPLICATES_SWEEP_SIZE:
+        return sweep_duplicates(SVs, distance_cutoff)
     for ind_i in range(len(SVs)-1):
         if SVs[ind_i].vcf_id in bad_svs:
             continue
@@ -27,56 +31,231 @@ def get_duplicates(SVs, distance_cutoff):
                 bad_svs.add(SVs[ind_j].vcf_id)
     return bad_svs
 
-def annotate(SVs: List[SV], freq_dbs: List, config):
-    tbx_gtf = pysam.TabixFile(config['gene_tbx'])
+def sweep_duplicates(SVs, distance_cutoff):
+    '''
+    get_duplicates of SVs already in order of priority, comparing only pairs that can be
+    within distance_cutoff (see Interval_array.get_candidates)
+    '''
+    bad_svs = set()
+    intervals = Interval_array.from_intervals(SVs)
+    for ind_i in range(len(SVs)-1):
+        sv = SVs[ind_i]
+        if sv.vcf_id in bad_svs:
+            continue
+        if distance_cutoff < 1:
+            candidates = intervals.get_candidates(ind_i, distance_cutoff)
+            candidates = candidates[candidates > ind_i]
+        else:
+            candidates = np.arange(ind_i+1, len(SVs))
+        if not len(candidates):
+            continue
+        # vcf_ids marked already stay marked, so they needn't be skipped
+        distances = intervals.get_distances(sv, candidates)
+        for ind_j in candidates[distances <= distance_cutoff].tolist():
+            bad_svs.add(SVs[ind_j].vcf_id)
+    return bad_svs
+
+def get_uncached(SVs: List[SV], connection, fingerprint) -> List[SV]:
+    '''
+    Set annotations of SVs found in the annotation cache, return the others, to be annotated
+    and saved to the cache.
+    '''
+    if fingerprint is None:
+        return SVs
+    cached = annotation_cache.load(connection, (sv.name for sv in SVs), fingerprint)
+    new_SVs = []
     for sv in SVs:
-        # external freqs. Note that only gnomad supports annotation for INV
-        for freq_db in freq_dbs:
-            if freq_db['name'] == 'dbvar':
-                key = f"{freq_db['name']}_count"
-                if sv.svtype == Types.SVtype.INV:
-                    setattr(sv, key, None)
-                else:
-                    setattr(sv, key, (freq_db[sv.svtype.value].get_count(sv, 0.5)))
-            else:
-                key = f"{freq_db['name']}_freq"
-                if sv.svtype == Types.SVtype.INV and freq_db['name'] != 'gnomad':
-                    setattr(sv, key, None)
-                else:
-                    setattr(sv, key, (freq_db[sv.svtype.value].get_freq(sv, 0.5)))
-        # genes
-        genes = utils._get_overlap(sv, 'gene', tbx_gtf, True, False)
-        setattr(sv, 'genes', genes)
-        # cdss
-        cdss = utils.get_protein_coding_disrupted_genes(sv, sv.svtype, tbx_gtf, feature='CDS')
-        setattr(sv, 'cdss', cdss)
-        # exons
-        exons = utils.get_protein_coding_disrupted_genes(sv, sv.svtype, tbx_gtf, feature='exon')
-        setattr(sv, 'exons', exons)
+        if sv.name in cached:
+            for key, val in cached[sv.name].items():
+                setattr(sv, key, copy.copy(val))
+            continue
+        new_SVs.append(sv)
+    return new_SVs
+
+def annotate(SVs: List[SV], freq_dbs: List, config, gtf_index=None, mode='lookup', pool=None):
+    '''
+    annotate by pool if given, or in this process, see lib/annotation.py
+    '''
+    if pool is not None:
+        pool.annotate(SVs)
+    else:
+        annotation.annotate_batch(SVs, freq_dbs, config, gtf_index, mode)
+
+def get_patient(input_patient) -> Patient:
+    return Patient(
+        name = input_patient['name'],
+        canvas_file = input_patient.get('canvas_path', None),
+        manta_file = input_patient.get('manta_path', None),
+        bam_file = input_patient['bam_path'],
+        svtools_file = input_patient.get('svtools_path', None),
+        pbsv_file = input_patient.get('pbsv_path', None),
+    )
+
+def get_parse_options(import_config) -> dict:
+    '''
+    contigs and FILTER values to import (see Patient.parse_records), all of them by default
+    '''
+    options = {'contigs': import_config.get('contigs', None)}
+    if import_config.get('filters', None) is not None:
+        options['keep_filter'] = Filter_set(import_config['filters'])
+    return options
+
+def iter_records(patients: List[dict], parse_pool=None, parse_options: dict = None, cohort: Cohort = None) -> Iterator[Tuple[dict, np.ndarray]]:
+    '''
+    SV records of manta / canvas etc. of each patient, on Types.CHROMOSOMES only
+    parse_options are for Patient.parse_all, the parse_pool has its own.
+    VCFs shared by patients are read once for all of them through cohort, if given
+    '''
+    if parse_pool is None:
+        return ((input_patient, get_patient(input_patient).parse_all(**(parse_options or {}), cohort=cohort)) for input_patient in patients)
+    return zip(patients, parse_pool.map((get_patient(input_patient) for input_patient in patients), cohort))
+
+def find_duplicates(SVs: List[SV], distance_cutoff) -> List:
+    '''
+    groups of SVs with their duplicates (vcf_ids), see get_duplicates
+    '''
+    result = []
+    for group in Interval_base.group(SVs):
+        result.append((group.intervals, get_duplicates(group.intervals, distance_cutoff)))
+    return result
+
+class SV_ids(object):
+    '''
+    SV.name -> SV.id, loaded once per chromosome, with ids of new SVs assigned here,
+    so SVs and their genes can be inserted in bulk without a flush per SV.
+    Only valid while this is the only writer of SV.
+    '''
+    def __init__(self, connection):
+        self.ids: Dict[str, int] = {}
+        self.chroms = set()
+        self.next_id = (connection.execute(sa.select(sa.func.max(models.SV.id))).scalar() or 0) + 1
+
+    def load(self, connection, chrom: str):
+        if chrom in self.chroms:
+            return
+        rows = connection.execute(
+            sa.select(models.SV.name, models.SV.id)
+            .where(models.SV.chrom == chrom)
+            .order_by(models.SV.id)
+        )
+        for name, sv_id in rows:
+            # the first one, as query().first() would
+            self.ids.setdefault(name, sv_id)
+        self.chroms.add(chrom)
+
+    def add(self, name: str) -> int:
+        sv_id = self.ids[name] = self.next_id
+        self.next_id += 1
+        return sv_id
+
+def write_patient(session, input_patient, SVs: List[SV], new_SVs: List[SV], duplicates: List, fingerprint, generation, sv_ids: SV_ids):
+    '''
+    write SVs of a patient, and save new_SVs to the annotation cache if fingerprint is given.
+    Rows are inserted in batches (executemany), new SVs taking their ids from sv_ids
+    '''
+    connection = session.connection()
+    if fingerprint is not None:
+        annotation_cache.save(connection, new_SVs, fingerprint)
+    # import SV
+    sv_rows = []
+    gene_rows = {models.SV_Gene: [], models.SV_CDS: [], models.SV_Exon: []}
+    for sv in SVs:
+        # if sv already there?
+        sv_ids.load(connection, sv.chrom)
+        sv_id = sv_ids.ids.get(sv.name)
+        if sv_id is None:
+            sv_id = sv_ids.add(sv.name)
+            sv_rows.append({
+                'id': sv_id,
+                'name': sv.name,
+                'chrom': sv.chrom,
+                'start': sv.start,
+                'end': sv.end,
+                'sv_type': sv.svtype.value,
+                'gnomad_freq': sv.gnomad_freq,
+                'dbvar_count': sv.dbvar_count,
+                'decipher_freq': sv.decipher_freq,
+            })
+            # SV_gene/CDS/exon
+            for model, genes in ((models.SV_Gene, sv.genes), (models.SV_CDS, sv.cdss), (models.SV_Exon, sv.exons)):
+                gene_rows[model].extend({'sv_id': sv_id, 'gene_id': int(gene.lstrip('ENSG'))} for gene in genes)
+        sv.id = sv_id
+
+    # deal with duplicates
+    patient_sv_rows = []
+    done = set()
+    for intervals, duplicate_svs in duplicates:
+        for sv in intervals:
+            if sv.id in done:
+                continue
+            patient_sv_rows.append({
+                'patient_id': input_patient['id'],
+                'sv_id': sv.id,
+                'genotype': sv.genotype.value,
+                'vcf_id': sv.vcf_id,
+                'source': sv.source,
+                'filter': sv.FILTER,
+                'is_duplicate': True if sv.vcf_id in duplicate_svs else False,
+                'import_generation': generation,
+            })
+            done.add(sv.id)
+    for model, rows in [(models.SV, sv_rows)] + list(gene_rows.items()) + [(models.Patient_SV, patient_sv_rows)]:
+        if rows:
+            connection.execute(sa.insert(model.__table__), rows)
+    session.commit()
         
         
 def main(config):
     engine = sa.create_engine(config['db'])
+    # sqlite PRAGMAs for loading, and non unique indexes of SV and Patient_SV dropped while SVs are written
+    bulk = config.get('bulk_load', False)
+    if bulk:
+        bulk_load.set_pragmas(engine)
+    # create tables and columns added since the database was made, and make sure the SV R*Tree is in sync
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        models.add_missing_columns(connection)
+        models.create_sv_rtree(connection)
+    # indexes left dropped by an interrupted bulk load. A new one takes them over, and
+    # rebuilds them along with its own, instead of building them just to drop them again
+    if bulk:
+        bulk_load.drop_indexes(engine, [models.SV.__table__, models.Patient_SV.__table__])
+    else:
+        bulk_load.repair(engine)
     session = Session(engine)
-    freq_dbs = [
-        {
-            'name': 'gnomad',
-            'LOSS': gnomad.Gnomad(config['gnomad'], 'LOSS'),
-            'GAIN': gnomad.Gnomad(config['gnomad'], 'GAIN'),
-            'INV': gnomad.Gnomad(config['gnomad'], 'INV'),
-        },
-        {
-            'name': 'dbvar',
-            'LOSS': dbvar.Dbvar(config['dbvar']['LOSS'], 'LOSS'),
-            'GAIN': dbvar.Dbvar(config['dbvar']['GAIN'], 'GAIN'),
-        },
-        {
-            'name': 'decipher',
-            'LOSS': decipher.Decipher(config['decipher'], 'LOSS'),
-            'GAIN': decipher.Decipher(config['decipher'], 'GAIN'),
-        }
-    ]
+    import_config = config.get('import', {})
+    # mark Patient_SV rows of this run, for incremental N_carriers.
+    # A run that did not finish is resumed with its generation (see lib/ledger.py).
+    # Needs import_generation, added to older databases by add_missing_columns above
+    generation, resumed = ledger.start_run(session.connection(), carriers.get_generation(session.connection()) + 1)
+    session.commit()
+    if resumed:
+        print(f"resuming import {generation}")
+    # annotations of SVs seen before, with the same reference files
+    fingerprint = None
+    if import_config.get('annotation_cache', False):
+        fingerprint = annotation_cache.get_fingerprint(config)
+        annotation_cache.invalidate(session.connection(), fingerprint)
+    freq_dbs = annotation.build_freq_dbs(config)
     
+    # genes/exons/CDS held in memory
+    gtf_index = None
+    if import_config.get('gtf_index', False):
+        gtf_index = gtf.load(config)
+
+    # lookup: tabix lookups per SV, merge: sorted merge join per chromosome
+    annotation_mode = import_config.get('annotation_mode', 'lookup')
+    # annotate in worker processes, sharded by chromosome
+    pool = None
+    if import_config.get('annotation_workers', 1) > 1:
+        pool = annotation.Annotation_pool(
+            config,
+            import_config['annotation_workers'],
+            chunk_size=import_config.get('annotation_chunk_size', 500),
+            mode=annotation_mode,
+            use_gtf_index=gtf_index is not None,
+        )
+
     # read patients
     patients = []
     with open(config['patients'], 'rt') as inf:
@@ -88,9 +267,14 @@ def main(config):
                 continue
             patients.append(dict(zip(header, row)))
             
-    # import patients
+    # import patients, those already in the db (of an earlier or interrupted run) keep their rows
+    patient_ids = dict(session.query(models.Patient.name, models.Patient.id).filter(
+        models.Patient.name.in_([patient['name'] for patient in patients])
+    ))
     entities = []
     for patient in patients:
+        if patient['name'] in patient_ids:
+            continue
         entities.append(models.Patient(
             name = patient['name'],
             family_id = patient['family_id'],
@@ -111,6 +295,9 @@ def main(config):
     # import patient_hpo
     entities = []
     for patient in patients:
+        if patient['name'] in patient_ids:
+            patient['id'] = patient_ids[patient['name']]
+            continue
         patient_id = None
         patient_id = session.query(models.Patient).filter(models.Patient.name == patient['name']).one().id
         if patient_id is None:
@@ -128,125 +315,121 @@ def main(config):
     session.add_all(entities)
     session.flush()
     
+    # skip patients written before. Those imported before the ledger count as written if they have SVs
+    patient_stages = ledger.get_patients(session.connection())
+    with_SVs = set(row[0] for row in session.query(models.Patient_SV.patient_id).filter(
+        models.Patient_SV.patient_id.in_(patient_ids.values())
+    ).distinct())
+    to_import = []
+    for patient in patients:
+        patient['fingerprint'] = ledger.get_fingerprint(patient)
+        stage, vcf_fingerprint = patient_stages.get(patient['name'], (None, None))
+        if stage is None and patient['id'] in with_SVs:
+            ledger.set_patient_stage(session.connection(), patient['name'], generation, 'written', patient['fingerprint'])
+            stage, vcf_fingerprint = 'written', patient['fingerprint']
+        if stage != 'written':
+            to_import.append(patient)
+            continue
+        if vcf_fingerprint != patient['fingerprint']:
+            print(f"WARNING: VCFs of {patient['name']} changed since it was imported, not imported again")
+        print(f"skipping {patient['name']}, imported already")
+    session.commit()
     
     # deal with SVs    
-    for input_patient in patients:
-        print(f"importing {input_patient['name']}")
-        patient = Patient(
-            name = input_patient['name'],
-            canvas_file = input_patient.get('canvas_path', None),
-            manta_file = input_patient.get('manta_path', None),
-            bam_file = input_patient['bam_path'],
-            svtools_file = input_patient.get('svtools_path', None),
-            pbsv_file = input_patient.get('pbsv_path', None),
+    distance = config['params']['distance']
+    # parse VCFs of patients in worker processes
+    parse_options = get_parse_options(import_config)
+    parse_pool = None
+    if import_config.get('parse_workers', 1) > 1:
+        parse_pool = Parse_pool(import_config['parse_workers'], **parse_options)
+    # joint called VCFs are read once for all their patients
+    cohort = None
+    if import_config.get('cohort', False):
+        cohort = Cohort([get_patient(input_patient) for input_patient in to_import], **parse_options)
+    records = iter_records(to_import, parse_pool, parse_options, cohort)
+    # ids of SVs in the db, and of new ones
+    sv_ids = SV_ids(session.connection())
+    if import_config.get('pipeline', False):
+        # parse and annotate the next patients while one is written by this thread.
+        # VCFs are parsed as records are drawn from iter_records
+        # The annotation cache is read through its own connection, and written by this thread only
+        def annotate_stage(item):
+            input_patient, SVs = item
+            # a short read, so the writer can commit
+            with engine.connect() as connection:
+                new_SVs = get_uncached(SVs, connection, fingerprint)
+            annotate(new_SVs, freq_dbs, config, gtf_index, annotation_mode, pool)
+            return input_patient, SVs, new_SVs, find_duplicates(SVs, distance)
+        import_pipeline = pipeline.Pipeline(
+            [
+                ('records', lambda item: (item[0], records_to_SVs(item[1]))),
+                ('annotate', annotate_stage),
+            ],
+            depth=import_config.get('pipeline_depth', 2),
+            size=lambda item: len(item[1]),
         )
-        # get manta / canvas etc.
-        SVs = patient.parse_vcf('manta') + patient.parse_vcf('canvas') + patient.parse_vcf('svtools') + patient.parse_vcf('pbsv')
-        # filter SVs on chromosomes
-        SVs = list(filter(lambda x: x.chrom in CHROMOSOMES, SVs))
-        # annotate SVs
-        annotate(SVs, freq_dbs, config)
-        # import SV
-        for sv in SVs:
-            # if sv already there?
-            sv_id = None
-            db_sv = session.query(models.SV).filter(models.SV.name == sv.name).first()
-            if db_sv is not None:
-                sv_id = db_sv.id
-            else:
-                sv_entity = models.SV(
-                    name = sv.name,
-                    chrom = sv.chrom,
-                    start = sv.start,
-                    end = sv.end,
-                    sv_type = sv.svtype.value,
-                    gnomad_freq = sv.gnomad_freq,
-                    dbvar_count = sv.dbvar_count,
-                    decipher_freq = sv.decipher_freq,
-                )
-                session.add(sv_entity)
-                # session flush to get id
-                session.flush()
-                sv_id = sv_entity.id
-                # SV_gene/CDS/exon
-                for gene in sv.genes:
-                    entity = models.SV_Gene(
-                        sv_id = sv_id,
-                        gene_id = int(gene.lstrip('ENSG')),
-                    )
-                    session.add(entity)
-                for gene in sv.cdss:
-                    entity = models.SV_CDS(
-                        sv_id = sv_id,
-                        gene_id = int(gene.lstrip('ENSG')),
-                    )
-                    session.add(entity)
-                for gene in sv.exons:
-                    entity = models.SV_Exon(
-                        sv_id = sv_id,
-                        gene_id = int(gene.lstrip('ENSG')),
-                    )
-                    session.add(entity)
-            sv.id = sv_id
-                        
-        # deal with duplicates
-        groups = Interval_base.group(SVs)
-        done = set()
-        for group in groups:
-            duplicate_svs = get_duplicates(group.intervals, config['params']['distance'])
-            for sv in group.intervals:
-                if sv.id in done:
-                    continue
-                Patient_SV_entity = models.Patient_SV(
-                    patient_id = input_patient['id'],
-                    sv_id = sv.id,
-                    genotype = sv.genotype.value,
-                    vcf_id = sv.vcf_id,
-                    source = sv.source,
-                    filter = sv.FILTER,
-                    is_duplicate = True if sv.vcf_id in duplicate_svs else False,
-                )
-                done.add(sv.id)
-                session.add(Patient_SV_entity)
-        session.commit()
+        write_counter = pipeline.Stage_counter('write')
+        for input_patient, SVs, new_SVs, duplicates in import_pipeline.run(records):
+            print(f"importing {input_patient['name']}")
+            start = time.time()
+            # written in the same transaction as its SVs
+            ledger.set_patient_stage(session.connection(), input_patient['name'], generation, 'written', input_patient['fingerprint'])
+            write_patient(session, input_patient, SVs, new_SVs, duplicates, fingerprint, generation, sv_ids)
+            write_counter.add(len(SVs), time.time() - start)
+        for counter in import_pipeline.counters + [write_counter]:
+            print(counter)
+    else:
+        for input_patient, patient_records in records:
+            print(f"importing {input_patient['name']}")
+            ledger.set_patient_stage(session.connection(), input_patient['name'], generation, 'parsed', input_patient['fingerprint'])
+            session.commit()
+            SVs = records_to_SVs(patient_records)
+            # annotate SVs, saved to the annotation cache by write_patient
+            new_SVs = get_uncached(SVs, session.connection(), fingerprint)
+            annotate(new_SVs, freq_dbs, config, gtf_index, annotation_mode, pool)
+            ledger.set_patient_stage(session.connection(), input_patient['name'], generation, 'annotated', input_patient['fingerprint'])
+            session.commit()
+            duplicates = find_duplicates(SVs, distance)
+            ledger.set_patient_stage(session.connection(), input_patient['name'], generation, 'written', input_patient['fingerprint'])
+            write_patient(session, input_patient, SVs, new_SVs, duplicates, fingerprint, generation, sv_ids)
     session.commit()
-    # N_carriers
-    # this step will take 3 days for 25k SVs!!
-    # TODO: speed up (parallelise?)
-    inner_session = Session(engine)
+    if bulk:
+        bulk_load.rebuild_indexes(engine)
+    if pool is not None:
+        pool.close()
+    if parse_pool is not None:
+        parse_pool.close()
+    # N_carriers, partitions written by an interrupted run are done, unless patients were written since
+    with engine.begin() as connection:
+        if to_import:
+            ledger.clear_partitions(connection, generation)
+        ledger.set_run_stage(connection, generation, 'carriers')
+        done_partitions = ledger.get_partitions(connection, generation)
+    checkpoint = lambda connection, partition: ledger.set_partition_done(connection, generation, partition)
     print('calculate N_carriers')
-    #! sqlite doesn't have Math.Max/Min like function to do this live. So have an additional manual check
-    N = 0
-    for sv in session.query(models.SV):
-        N += 1
-        if not N % 10000:
-            print(N)
-        sv_size = sv.end - sv.start
-        overlapping_svs = inner_session.query(models.SV, models.Patient_SV, models.Patient)\
-            .join(models.Patient_SV, models.SV.id == models.Patient_SV.sv_id)\
-            .join(models.Patient, models.Patient_SV.patient_id == models.Patient.id)\
-            .filter(
-                (models.SV.chrom == sv.chrom) &
-                (models.SV.sv_type == sv.sv_type) &
-                (models.SV.end >= sv.end - sv_size * config['params']['distance']) &
-                (models.SV.end <= sv.end + sv_size * (1 / (1 - config['params']['distance']) - 1)) &
-                (models.SV.start <= sv.start + sv_size * config['params']['distance']) &
-                (models.SV.start >= sv.start - sv_size * (1 / (1 - config['params']['distance']) -1))
-            )
-        carriers = set()
-        for os in overlapping_svs:
-            # result is a joined table,
-            # os[0] is SV, os[1] is Patient_SV, os[2] is Patient
-            # get unique family_id
-            denominator = max(os[0].end, sv.end) - min(os[0].start, sv.start)
-            if denominator == 0:
-                similarity = 1
-            else:
-                similarity = (min(os[0].end, sv.end) - max(os[0].start, sv.start)) / denominator
-            if similarity >= 1 - config['params']['distance']:
-                carriers.add(os[2].family_id)
-        sv.N_carriers = len(carriers)
-    session.commit()
+    if import_config.get('incremental_carriers', False):
+        carriers.update_N_carriers_incremental(
+            engine,
+            config['params']['distance'],
+            generation,
+            skip=done_partitions,
+            checkpoint=checkpoint,
+        )
+    else:
+        carriers.update_N_carriers(
+            engine,
+            config['params']['distance'],
+            workers=import_config.get('carrier_workers', 1),
+            skip=done_partitions,
+            checkpoint=checkpoint,
+        )
+    # SV_Cluster, rebuilt for the whole cohort
+    if import_config.get('sv_clusters', False):
+        print('cluster SVs')
+        clusters.update_clusters(engine, config['params']['distance'])
+    with engine.begin() as connection:
+        ledger.set_run_stage(connection, generation, 'done')
+
 if __name__ == '__main__':
     with open('config.yml', 'rt') as inf:
         config = yaml.safe_load(inf)
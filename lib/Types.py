@@ -25,6 +25,14 @@ class SVtype(Enum):
     REF = 'REF'
     UNKNOWN = None
 
+# chromosomes to import. Their index is the chrom code of SV records, see patient.Patient.parse_records
+CHROMOSOMES = [str(i) for i in range(23)] + ['X', 'Y']
+CHROMOSOMES += [f"chr{i}" for i in CHROMOSOMES]
+CHROMOSOME_CODES = {chrom: ind for ind, chrom in enumerate(CHROMOSOMES)}
+# codes of SVtype and Genotype in SV records
+SVTYPES = list(SVtype)
+GENOTYPES = list(Genotype)
+
 @attr.s(frozen=True)
 class Cutoffs:
     internal: float = attr.ib()
@@ -0,0 +1,207 @@
+'''
+annotate SVs with external frequencies (gnomAD, dbVar, DECIPHER) and genes/CDS/exons
+annotate_batch does a batch in this process. Annotation_pool shards batches by chromosome
+across worker processes, each opening its own readers once, as tabix handles can't be shared.
+'''
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Tuple
+import pysam
+from lib import dbvar, decipher, gnomad, gtf, merge_join, utils, Types
+from lib.patient import SV
+
+# state of a worker process, see _init_worker
+_worker = {}
+
+
+def build_freq_dbs(config) -> List[Dict]:
+    import_config = config.get('import', {})
+    # dbvar and decipher are small enough to be held in memory
+    in_memory = import_config.get('in_memory_references', False)
+    # one reader per file, shared by all SV types
+    gnomad_reader = gnomad.Gnomad_reader(config['gnomad'])
+    decipher_reader = decipher.Decipher_reader(config['decipher'])
+    return [
+        {
+            'name': 'gnomad',
+            'LOSS': gnomad.Gnomad(config['gnomad'], 'LOSS', sidecar=config.get('gnomad_sidecar'), reader=gnomad_reader),
+            'GAIN': gnomad.Gnomad(config['gnomad'], 'GAIN', sidecar=config.get('gnomad_sidecar'), reader=gnomad_reader),
+            'INV': gnomad.Gnomad(config['gnomad'], 'INV', sidecar=config.get('gnomad_sidecar'), reader=gnomad_reader),
+        },
+        {
+            'name': 'dbvar',
+            'LOSS': dbvar.Dbvar(config['dbvar']['LOSS'], 'LOSS', in_memory=in_memory),
+            'GAIN': dbvar.Dbvar(config['dbvar']['GAIN'], 'GAIN', in_memory=in_memory),
+        },
+        {
+            'name': 'decipher',
+            'LOSS': decipher.Decipher(config['decipher'], 'LOSS', in_memory=in_memory, reader=decipher_reader),
+            'GAIN': decipher.Decipher(config['decipher'], 'GAIN', in_memory=in_memory, reader=decipher_reader),
+        }
+    ]
+
+
+def annotate_freqs(sv: SV, freq_dbs: List):
+    # external freqs. Note that only gnomad supports annotation for INV
+    for freq_db in freq_dbs:
+        if freq_db['name'] == 'dbvar':
+            key = f"{freq_db['name']}_count"
+            if sv.svtype == Types.SVtype.INV:
+                setattr(sv, key, None)
+            else:
+                setattr(sv, key, (freq_db[sv.svtype.value].get_count(sv, 0.5)))
+        else:
+            key = f"{freq_db['name']}_freq"
+            if sv.svtype == Types.SVtype.INV and freq_db['name'] != 'gnomad':
+                setattr(sv, key, None)
+            else:
+                setattr(sv, key, (freq_db[sv.svtype.value].get_freq(sv, 0.5)))
+
+
+def annotate_genes(sv: SV, tbx_gtf):
+    # genes
+    genes = utils._get_overlap(sv, 'gene', tbx_gtf, True, False)
+    setattr(sv, 'genes', genes)
+    # cdss
+    cdss = utils.get_protein_coding_disrupted_genes(sv, sv.svtype, tbx_gtf, feature='CDS')
+    setattr(sv, 'cdss', cdss)
+    # exons
+    exons = utils.get_protein_coding_disrupted_genes(sv, sv.svtype, tbx_gtf, feature='exon')
+    setattr(sv, 'exons', exons)
+
+
+def annotate_sorted(SVs: List[SV], freq_dbs: List, config, gtf_index=None):
+    '''
+    Merge join of SVs sorted by (chrom, start) against the reference files.
+    Each file not held in memory is walked once per chromosome, see lib/merge_join.py
+    '''
+    by_chrom = {}
+    for sv in sorted(SVs, key=lambda x: (x.chrom, x.start)):
+        by_chrom.setdefault(sv.chrom, []).append(sv)
+    # one walk per file, shared by sources of different SV types
+    readers = {}
+    for freq_db in freq_dbs:
+        for key, source in freq_db.items():
+            if key != 'name' and source.index is None:
+                readers[id(source.reader)] = source.reader
+    gtf_reader = gtf.Gtf_reader(config['gene_tbx']) if gtf_index is None else None
+    for chrom, chrom_SVs in by_chrom.items():
+        queries = [(max(0, sv.start - 1), sv.end, sv) for sv in chrom_SVs]
+        streams = {key: merge_join.stream(reader, chrom, queries) for key, reader in readers.items()}
+        gtf_stream = None
+        if gtf_reader is not None:
+            gtf_chrom = chrom.lstrip('chr')
+            if gtf_chrom == 'M':
+                gtf_chrom = 'MT'
+            # one region covering the SV and the genes at both of its ends
+            gtf_stream = merge_join.stream(gtf_reader, gtf_chrom, [(sv.start, sv.end + 1, sv) for sv in chrom_SVs])
+        for sv in chrom_SVs:
+            swept = {key: next(stream) for key, stream in streams.items()}
+            sv_freq_dbs = []
+            for freq_db in freq_dbs:
+                sv_freq_db = {'name': freq_db['name']}
+                source = freq_db.get(sv.svtype.value)
+                if source is not None and source.index is None:
+                    source = copy.copy(source)
+                    source.reader = swept[id(source.reader)]
+                if source is not None:
+                    sv_freq_db[sv.svtype.value] = source
+                sv_freq_dbs.append(sv_freq_db)
+            annotate_freqs(sv, sv_freq_dbs)
+            if gtf_stream is not None:
+                annotate_genes(sv, next(gtf_stream))
+
+
+def annotate_batch(SVs: List[SV], freq_dbs: List, config, gtf_index=None, mode='lookup'):
+    '''
+    With a gtf_index, genes/cdss/exons are found for all SVs in batch instead of tabix lookups.
+    mode is either lookup (tabix lookups per SV) or merge (see annotate_sorted).
+    '''
+    if mode not in ('lookup', 'merge'):
+        raise ValueError(f"annotation mode has to be either lookup or merge, got {mode}")
+    if mode == 'merge':
+        annotate_sorted(SVs, freq_dbs, config, gtf_index)
+    else:
+        tbx_gtf = pysam.TabixFile(config['gene_tbx']) if gtf_index is None else None
+        for sv in SVs:
+            annotate_freqs(sv, freq_dbs)
+            if gtf_index is None:
+                annotate_genes(sv, tbx_gtf)
+    if gtf_index is not None and SVs:
+        genes = gtf_index.get_overlaps(
+            [sv.chrom for sv in SVs],
+            [sv.start for sv in SVs],
+            [sv.end for sv in SVs],
+            'gene', True, False)
+        cdss = gtf_index.get_protein_coding_disrupted_genes(SVs, feature='CDS')
+        exons = gtf_index.get_protein_coding_disrupted_genes(SVs, feature='exon')
+        for sv, sv_genes, sv_cdss, sv_exons in zip(SVs, genes, cdss, exons):
+            sv.genes = sv_genes
+            sv.cdss = sv_cdss
+            sv.exons = sv_exons
+
+
+def _init_worker(config, mode: str, use_gtf_index: bool):
+    # readers are opened once per worker, and kept for all its chunks
+    _worker['config'] = config
+    _worker['mode'] = mode
+    _worker['freq_dbs'] = build_freq_dbs(config)
+    _worker['gtf_index'] = gtf.load(config) if use_gtf_index else None
+
+
+def _annotate_chunk(chunk: List[Tuple[str, int, int, str]]) -> List[Tuple]:
+    '''
+    chunk of (chrom, start, end, svtype),
+    return (gnomad_freq, dbvar_count, decipher_freq, genes, cdss, exons) for each
+    '''
+    SVs = [SV(chrom, start, end, Types.SVtype(svtype), None, None, None, None) for chrom, start, end, svtype in chunk]
+    annotate_batch(SVs, _worker['freq_dbs'], _worker['config'], _worker['gtf_index'], _worker['mode'])
+    return [(
+        sv.gnomad_freq,
+        sv.dbvar_count,
+        sv.decipher_freq,
+        tuple(sv.genes),
+        sv.cdss,
+        sv.exons,
+    ) for sv in SVs]
+
+
+class Annotation_pool(object):
+    '''
+    annotate batches in worker processes, in chunks of up to chunk_size SVs of one chromosome
+    '''
+    def __init__(self, config, workers: int, chunk_size: int = 500, mode: str = 'lookup', use_gtf_index: bool = False):
+        if mode not in ('lookup', 'merge'):
+            raise ValueError(f"annotation mode has to be either lookup or merge, got {mode}")
+        self.chunk_size = chunk_size
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(config, mode, use_gtf_index),
+        )
+
+    def annotate(self, SVs: List[SV]):
+        order = sorted(range(len(SVs)), key=lambda ind: (SVs[ind].chrom, SVs[ind].start))
+        chunks = []
+        for ind in order:
+            if not chunks or len(chunks[-1]) == self.chunk_size or SVs[chunks[-1][-1]].chrom != SVs[ind].chrom:
+                chunks.append([])
+            chunks[-1].append(ind)
+        results = self.executor.map(
+            _annotate_chunk,
+            [[(SVs[ind].chrom, SVs[ind].start, SVs[ind].end, SVs[ind].svtype.value) for ind in chunk] for chunk in chunks],
+        )
+        for chunk, chunk_result in zip(chunks, results):
+            for ind, result in zip(chunk, chunk_result):
+                sv = SVs[ind]
+                sv.gnomad_freq, sv.dbvar_count, sv.decipher_freq, genes, sv.cdss, sv.exons = result
+                sv.genes = set(genes)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
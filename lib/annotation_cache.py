@@ -0,0 +1,90 @@
+'''
+persistent annotation cache
+Annotations (external freqs and gene/CDS/exon lists) of an SV only depend on SV.name
+and the reference files, so they are stored in Annotation_cache keyed by
+(name, fingerprint of the reference files). Entries of other fingerprints are stale.
+The fingerprint is of the paths, sizes and modification times of the reference files,
+as checksums of the gnomAD VCF on every import would take too long.
+'''
+import hashlib
+import sqlalchemy as sa
+from typing import Dict, Iterable, List
+from lib import models, utils
+
+# bump when annotation logic changes, to invalidate cached entries
+VERSION = 1
+# names per IN query
+BATCH_SIZE = 500
+
+
+def get_fingerprint(config) -> str:
+    reference_files = [
+        ('gnomad', config['gnomad']),
+        ('dbvar_LOSS', config['dbvar']['LOSS']),
+        ('dbvar_GAIN', config['dbvar']['GAIN']),
+        ('decipher', config['decipher']),
+        ('gene_tbx', config['gene_tbx']),
+    ]
+    md5 = hashlib.md5(f"version={VERSION}".encode())
+    for key, fname in reference_files:
+        md5.update(f";{key}={utils.file_fingerprint(fname)}".encode())
+    return md5.hexdigest()
+
+
+def invalidate(connection, fingerprint: str):
+    '''
+    drop entries made with other reference files
+    '''
+    connection.execute(
+        sa.delete(models.Annotation_cache).where(models.Annotation_cache.fingerprint != fingerprint)
+    )
+
+
+def load(connection, names: Iterable[str], fingerprint: str) -> Dict[str, dict]:
+    names = sorted(set(names))
+    result = {}
+    for i in range(0, len(names), BATCH_SIZE):
+        rows = connection.execute(
+            sa.select(models.Annotation_cache).where(
+                (models.Annotation_cache.fingerprint == fingerprint) &
+                (models.Annotation_cache.name.in_(names[i:i + BATCH_SIZE]))
+            )
+        ).mappings()
+        for row in rows:
+            result[row['name']] = {
+                'gnomad_freq': row['gnomad_freq'],
+                'dbvar_count': row['dbvar_count'],
+                'decipher_freq': row['decipher_freq'],
+                'genes': set(split_genes(row['genes'])),
+                'cdss': split_genes(row['cdss']),
+                'exons': split_genes(row['exons']),
+            }
+    return result
+
+
+def save(connection, SVs: List, fingerprint: str):
+    '''
+    store annotated SVs. SVs already in the cache are skipped,
+    as they might have been annotated before an earlier save was visible
+    '''
+    cached = load(connection, (sv.name for sv in SVs), fingerprint)
+    rows = {}
+    for sv in SVs:
+        if sv.name in cached:
+            continue
+        rows[sv.name] = {
+            'name': sv.name,
+            'fingerprint': fingerprint,
+            'gnomad_freq': sv.gnomad_freq,
+            'dbvar_count': sv.dbvar_count,
+            'decipher_freq': sv.decipher_freq,
+            'genes': ','.join(sv.genes),
+            'cdss': ','.join(sv.cdss),
+            'exons': ','.join(sv.exons),
+        }
+    if rows:
+        connection.execute(sa.insert(models.Annotation_cache), list(rows.values()))
+
+
+def split_genes(genes: str) -> List[str]:
+    return genes.split(',') if genes else []
@@ -0,0 +1,94 @@
+'''
+sqlite bulk-load mode
+Connections of the engine get PRAGMAs for loading (set_pragmas), and the non unique indexes of
+the loaded tables are dropped while loading, then rebuilt and ANALYZEd (rebuild_indexes).
+Indexes are dropped in the same transaction as a Bulk_load row is written, and the row is deleted
+in the same transaction as indexes are rebuilt, so a database with a Bulk_load row is one whose
+load was interrupted. repair rebuilds its indexes, or a new load takes them over: rebuild_indexes
+rebuilds the tables of all Bulk_load rows.
+'''
+import datetime
+import sqlalchemy as sa
+from typing import List
+from lib import models
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    # in KiB when negative, i.e. 256MB
+    'cache_size': -262144,
+    'temp_store': 'MEMORY',
+    'mmap_size': 1 << 30,
+}
+
+
+def set_pragmas(engine, pragmas: dict = PRAGMAS):
+    '''
+    set pragmas on every new connection of engine (sqlite only)
+    '''
+    if engine.dialect.name != 'sqlite':
+        return
+
+    def _set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for key, value in pragmas.items():
+            cursor.execute(f'PRAGMA {key} = {value}')
+        cursor.close()
+
+    sa.event.listen(engine, 'connect', _set_pragmas)
+    # connections made before don't have them
+    engine.dispose()
+
+
+def get_indexes(tables: List[sa.Table]) -> List[sa.Index]:
+    return [index for table in tables for index in sorted(table.indexes, key=lambda x: x.name) if not index.unique]
+
+
+def drop_indexes(engine, tables: List[sa.Table]):
+    '''
+    Bulk_load rows of an interrupted load are kept, so rebuild_indexes rebuilds their tables too
+    '''
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        started = connection.execute(sa.select(models.Bulk_load.started)).scalars().all()
+        if started:
+            print(f"taking over indexes dropped by a bulk load started at {min(started)}, which did not finish")
+        for index in get_indexes(tables):
+            index.drop(connection, checkfirst=True)
+        connection.execute(sa.insert(models.Bulk_load.__table__).values(
+            tables=','.join(table.name for table in tables),
+            started=datetime.datetime.now(),
+        ))
+
+
+def rebuild_indexes(engine):
+    '''
+    create the indexes of tables of Bulk_load rows, and ANALYZE
+    '''
+    if engine.dialect.name != 'sqlite':
+        return
+    with engine.begin() as connection:
+        names = set()
+        for (table_names,) in connection.execute(sa.select(models.Bulk_load.tables)):
+            names.update(table_names.split(','))
+        tables = [table for table in models.Base.metadata.sorted_tables if table.name in names]
+        for index in get_indexes(tables):
+            index.create(connection, checkfirst=True)
+        connection.execute(sa.delete(models.Bulk_load.__table__))
+        connection.exec_driver_sql('ANALYZE')
+
+
+def repair(engine) -> bool:
+    '''
+    rebuild indexes dropped by an interrupted load, return whether there was one
+    '''
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as connection:
+        started = connection.execute(sa.select(models.Bulk_load.started)).scalars().all()
+    if not started:
+        return False
+    print(f"rebuilding indexes dropped by a bulk load started at {min(started)}, which did not finish")
+    rebuild_indexes(engine)
+    return True
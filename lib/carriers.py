@@ -0,0 +1,232 @@
+'''
+count carriers of SVs
+N_carriers of an SV is the number of unique families carrying an SV of the same
+type on the same chromosome, with similarity (shared size / merged size) >= 1 - distance.
+Each (chrom, sv_type) partition is loaded once and swept in start order.
+The incremental mode only recomputes SVs that can match SVs of a given import_generation.
+Partitions are written one transaction each, along with a checkpoint (see lib/ledger.py),
+so an interrupted run can skip partitions written already.
+'''
+import numpy as np
+import sqlalchemy as sa
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Dict, List, Set, Tuple
+from lib import models
+
+# engine of a worker process, see _init_worker
+_worker_engine = None
+# number of start windows per query in incremental mode
+WINDOW_BATCH = 200
+
+
+def get_partitions(connection) -> List[Tuple[str, str]]:
+    query = sa.select(models.SV.chrom, models.SV.sv_type).distinct()
+    return sorted(tuple(row) for row in connection.execute(query))
+
+
+def load_partition(connection, chrom: str, sv_type: str, windows: List[Tuple[int, int]] = None):
+    '''
+    return sv ids, starts and ends of all SVs in the partition sorted by start,
+    and family_ids of each SV (only SVs seen in Patient_SV).
+    windows: only load SVs with start within the sorted, disjoint (lo, hi) windows
+    '''
+    in_partition = (models.SV.chrom == chrom) & (models.SV.sv_type == sv_type)
+    if windows is None:
+        conditions = [in_partition]
+    else:
+        # sqlite limits expression depth, so query windows in batches
+        conditions = [
+            in_partition & sa.or_(*(models.SV.start.between(lo, hi) for lo, hi in windows[i:i + WINDOW_BATCH]))
+            for i in range(0, len(windows), WINDOW_BATCH)
+        ]
+    svs = []
+    families: Dict[int, set] = {}
+    for condition in conditions:
+        svs.extend(connection.execute(
+            sa.select(models.SV.id, models.SV.start, models.SV.end)
+            .where(condition)
+            .order_by(models.SV.start, models.SV.id)
+        ))
+        carrier_rows = connection.execute(
+            sa.select(models.Patient_SV.sv_id, models.Patient.family_id)
+            .join(models.Patient, models.Patient_SV.patient_id == models.Patient.id)
+            .join(models.SV, models.SV.id == models.Patient_SV.sv_id)
+            .where(condition)
+            .distinct()
+        )
+        for sv_id, family_id in carrier_rows:
+            families.setdefault(sv_id, set()).add(family_id)
+    ids = np.array([row[0] for row in svs], dtype=np.int64)
+    starts = np.array([row[1] for row in svs], dtype=np.int64)
+    ends = np.array([row[2] for row in svs], dtype=np.int64)
+    return ids, starts, ends, families
+
+
+def count_carriers(ids, starts, ends, families: Dict[int, set], distance: float, query=None) -> np.ndarray:
+    '''
+    ids/starts/ends are sorted by start. Return N_carriers for ids[query] (default all).
+    Candidates are limited to the same bounds as the old per-SV sql filter,
+    and then checked for similarity >= 1 - distance.
+    '''
+    if query is None:
+        query = np.arange(len(ids))
+    result = np.zeros(len(query), dtype=np.int64)
+    # only SVs with carriers can contribute
+    has_carriers = np.array([sv_id in families for sv_id in ids], dtype=bool)
+    c_ids = ids[has_carriers]
+    c_starts = starts[has_carriers]
+    c_ends = ends[has_carriers]
+    if not len(c_ids):
+        return result
+    extension = 1 / (1 - distance) - 1
+    for n, ind in enumerate(query):
+        start = int(starts[ind])
+        end = int(ends[ind])
+        sv_size = end - start
+        lo = np.searchsorted(c_starts, start - sv_size * extension, side='left')
+        hi = np.searchsorted(c_starts, start + sv_size * distance, side='right')
+        if lo >= hi:
+            continue
+        o_starts = c_starts[lo:hi]
+        o_ends = c_ends[lo:hi]
+        in_bounds = (o_ends >= end - sv_size * distance) & (o_ends <= end + sv_size * extension)
+        denominator = np.maximum(o_ends, end) - np.minimum(o_starts, start)
+        shared = np.minimum(o_ends, end) - np.maximum(o_starts, start)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            similarity = np.where(denominator == 0, 1, shared / denominator)
+        matched = c_ids[lo:hi][in_bounds & (similarity >= 1 - distance)]
+        if len(matched):
+            result[n] = len(set().union(*(families[int(sv_id)] for sv_id in matched)))
+    return result
+
+
+def get_windows(starts, ends, distance: float):
+    '''
+    SVs can only match each other if similarity >= 1 - distance, which is symmetric.
+    So an SV matching one of the given SVs has its start in affected[i], and size <= max_sizes[i].
+    Its own candidates have their start in the returned (merged) load windows.
+    1bp slack is added to guard against rounding.
+    '''
+    sizes = ends - starts
+    extension = 1 / (1 - distance) - 1
+    max_sizes = sizes / (1 - distance) + 1
+    affected = np.stack((
+        np.floor(starts - sizes * extension) - 1,
+        np.ceil(starts + sizes * distance) + 1,
+    ), axis=1)
+    load = np.stack((
+        np.floor(affected[:, 0] - max_sizes * extension) - 1,
+        np.ceil(affected[:, 1] + max_sizes * distance) + 1,
+    ), axis=1)
+    windows = []
+    for lo, hi in sorted(load.tolist()):
+        if windows and lo <= windows[-1][1]:
+            windows[-1][1] = max(windows[-1][1], hi)
+        else:
+            windows.append([lo, hi])
+    return affected, max_sizes, [(int(lo), int(hi)) for lo, hi in windows]
+
+
+def write_N_carriers(connection, ids, n_carriers):
+    table = models.SV.__table__
+    stmt = sa.update(table)\
+        .where(table.c.id == sa.bindparam('_id'))\
+        .values(N_carriers=sa.bindparam('_N_carriers'))
+    rows = [{'_id': int(sv_id), '_N_carriers': int(n)} for sv_id, n in zip(ids, n_carriers)]
+    if rows:
+        connection.execute(stmt, rows)
+
+
+def get_generation(connection) -> int:
+    '''
+    the latest import_generation in Patient_SV, 0 if empty
+    '''
+    generation = connection.execute(
+        sa.select(sa.func.max(models.Patient_SV.import_generation))
+    ).scalar()
+    return generation or 0
+
+
+def write_partition(engine, partition: Tuple[str, str], ids, n_carriers, checkpoint: Callable = None):
+    '''
+    N_carriers of a partition, and its checkpoint(connection, partition) in the same transaction
+    '''
+    with engine.begin() as connection:
+        write_N_carriers(connection, ids, n_carriers)
+        if checkpoint is not None:
+            checkpoint(connection, partition)
+
+
+def update_N_carriers_incremental(engine, distance: float, generation: int, skip: Set[Tuple[str, str]] = (), checkpoint: Callable = None):
+    '''
+    Only recompute N_carriers for SVs that can match SVs touched by Patient_SV rows of the generation.
+    Cost is proportional to the new SVs and their neighbourhoods, not the whole SV table.
+    Partitions in skip are left as they are.
+    '''
+    with engine.connect() as connection:
+        touched = connection.execute(
+            sa.select(models.SV.chrom, models.SV.sv_type, models.SV.start, models.SV.end)
+            .join(models.Patient_SV, models.SV.id == models.Patient_SV.sv_id)
+            .where(models.Patient_SV.import_generation == generation)
+            .distinct()
+        )
+        partitions: Dict[Tuple[str, str], List[Tuple[int, int]]] = {}
+        for chrom, sv_type, start, end in touched:
+            if (chrom, sv_type) in skip:
+                continue
+            partitions.setdefault((chrom, sv_type), []).append((start, end))
+    for (chrom, sv_type), coords in sorted(partitions.items()):
+        new_starts = np.array([c[0] for c in coords], dtype=np.int64)
+        new_ends = np.array([c[1] for c in coords], dtype=np.int64)
+        affected, max_sizes, windows = get_windows(new_starts, new_ends, distance)
+        with engine.connect() as connection:
+            partition_ids, starts, ends, families = load_partition(connection, chrom, sv_type, windows)
+        sizes = ends - starts
+        to_update = np.zeros(len(partition_ids), dtype=bool)
+        for (lo, hi), max_size in zip(affected, max_sizes):
+            lo_ind = np.searchsorted(starts, lo, side='left')
+            hi_ind = np.searchsorted(starts, hi, side='right')
+            to_update[lo_ind:hi_ind] |= sizes[lo_ind:hi_ind] <= max_size
+        query = np.flatnonzero(to_update)
+        write_partition(
+            engine,
+            (chrom, sv_type),
+            partition_ids[query],
+            count_carriers(partition_ids, starts, ends, families, distance, query),
+            checkpoint,
+        )
+
+
+def _init_worker(db_url: str):
+    # each worker reads through its own engine, as connections can't be shared across processes
+    global _worker_engine
+    _worker_engine = sa.create_engine(db_url)
+
+
+def _count_partition(partition: Tuple[str, str], distance: float):
+    chrom, sv_type = partition
+    with _worker_engine.connect() as connection:
+        ids, starts, ends, families = load_partition(connection, chrom, sv_type)
+    return ids, count_carriers(ids, starts, ends, families, distance)
+
+
+def update_N_carriers(engine, distance: float, workers: int = 1, skip: Set[Tuple[str, str]] = (), checkpoint: Callable = None):
+    '''
+    workers > 1 computes partitions in a process pool.
+    Results are written by this process only, after the pool is done, so workers don't wait on the writer.
+    Partitions in skip are left as they are.
+    '''
+    with engine.connect() as connection:
+        partitions = [partition for partition in get_partitions(connection) if partition not in skip]
+    if workers <= 1:
+        for chrom, sv_type in partitions:
+            with engine.connect() as connection:
+                partition_ids, starts, ends, families = load_partition(connection, chrom, sv_type)
+            n_carriers = count_carriers(partition_ids, starts, ends, families, distance)
+            write_partition(engine, (chrom, sv_type), partition_ids, n_carriers, checkpoint)
+    elif partitions:
+        db_url = engine.url.render_as_string(hide_password=False)
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(db_url,)) as executor:
+            results = list(executor.map(_count_partition, partitions, [distance] * len(partitions)))
+        for partition, (partition_ids, n_carriers) in zip(partitions, results):
+            write_partition(engine, partition, partition_ids, n_carriers, checkpoint)
@@ -0,0 +1,99 @@
+'''
+cohort wide clusters of SVs
+SVs of each (chrom, sv_type) partition are grouped (Interval_base.group), and each group is
+split by DBSCAN (Group.get_labels) with eps distance on 1 - shared size / merged size.
+DBSCAN can chain SVs that don't all overlap, so its clusters are grouped again into Groups.
+Groups overlap, so an SV can come up in more than one cluster, or as noise in one group and in a
+cluster of another. Each SV is kept in one cluster only (see get_clusters), so counts over
+cluster_id count each SV once.
+SV_Cluster holds core, mean and loose intervals of clusters and the number of families carrying
+any of their SVs, SV_SV_Cluster maps SVs to clusters. Both are rebuilt from scratch.
+'''
+import sqlalchemy as sa
+from typing import Dict, List
+from lib import models, carriers
+from lib.interval import Interval_base, Annotated_interval, Group
+
+
+def get_clusters(chrom: str, ids, starts, ends, distance: float) -> List[Group]:
+    '''
+    clusters of SVs of a partition, as Groups of intervals with the SV id as sv_id.
+    Every SV is in exactly one of them
+    '''
+    intervals = []
+    for sv_id, start, end in zip(ids.tolist(), starts.tolist(), ends.tolist()):
+        interval = Annotated_interval(chrom, start, end)
+        interval.sv_id = sv_id
+        intervals.append(interval)
+    candidates: Dict[tuple, Group] = {}
+    by_id = {}
+    for group in Interval_base.group(intervals):
+        if not group.intervals:
+            continue
+        if len(group.intervals) == 1:
+            labels = [-1]
+        else:
+            labels = group.get_labels(distance).tolist()
+        members: Dict[int, list] = {}
+        for interval, label in zip(group.intervals, labels):
+            by_id[interval.sv_id] = interval
+            # noise here, it might still be in a cluster of another group
+            if label != -1:
+                members.setdefault(label, []).append(interval)
+        for member_intervals in members.values():
+            for cluster in Interval_base.group(member_intervals):
+                key = tuple(sorted(interval.sv_id for interval in cluster.intervals))
+                candidates.setdefault(key, cluster)
+    # an SV goes to the largest cluster it is in, ties to the one with the lowest SV ids.
+    # Clusters are Groups, so their SVs left still overlap the core
+    assigned: Dict[tuple, list] = {}
+    seen = set()
+    for key in sorted(candidates, key=lambda key: (-len(key), key)):
+        sv_ids = [sv_id for sv_id in key if sv_id not in seen]
+        if sv_ids:
+            assigned[key] = sv_ids
+            seen.update(sv_ids)
+    # SVs in no cluster are a cluster of their own
+    for sv_id in sorted(set(by_id) - seen):
+        assigned[(sv_id,)] = [sv_id]
+    clusters = []
+    for key in sorted(assigned, key=lambda key: min(assigned[key])):
+        cluster = Group()
+        for sv_id in assigned[key]:
+            cluster.add_interval(by_id[sv_id])
+        clusters.append(cluster)
+    return clusters
+
+
+def update_clusters(engine, distance: float):
+    clusters = []
+    members = []
+    with engine.connect() as connection:
+        for chrom, sv_type in carriers.get_partitions(connection):
+            ids, starts, ends, families = carriers.load_partition(connection, chrom, sv_type)
+            for cluster in get_clusters(chrom, ids, starts, ends, distance):
+                cluster_id = len(clusters) + 1
+                sv_ids = sorted({interval.sv_id for interval in cluster.intervals})
+                family_ids = set()
+                for sv_id in sv_ids:
+                    family_ids.update(families.get(sv_id, ()))
+                clusters.append({
+                    'id': cluster_id,
+                    'chrom': chrom,
+                    'sv_type': sv_type,
+                    'core_start': cluster.core_start,
+                    'core_end': cluster.core_end,
+                    'mean_start': cluster.mean_start,
+                    'mean_end': cluster.mean_end,
+                    'loose_start': cluster.loose_start,
+                    'loose_end': cluster.loose_end,
+                    'N_SVs': len(sv_ids),
+                    'N_carriers': len(family_ids),
+                })
+                members.extend({'sv_id': sv_id, 'cluster_id': cluster_id} for sv_id in sv_ids)
+    with engine.begin() as connection:
+        connection.execute(sa.delete(models.SV_SV_Cluster.__table__))
+        connection.execute(sa.delete(models.SV_Cluster.__table__))
+        if clusters:
+            connection.execute(sa.insert(models.SV_Cluster.__table__), clusters)
+            connection.execute(sa.insert(models.SV_SV_Cluster.__table__), members)
@@ -2,10 +2,33 @@
 parse dbvar
 return an Interval instance, and a dictionary for later annotation 
 '''
-import pysam
+import gzip
 from lib import Interval_base
+from lib.interval import Annotated_interval
+from lib.interval_index import Interval_index
+from lib.tabix_reader import Tabix_reader
 import functools
 
+
+class Dbvar_reader(Tabix_reader):
+    '''
+    a dbvar file holds one cnv_type, which is the only bucket
+    '''
+    def __init__(self, fname, cnv_type):
+        # dbvar has non-ASCII characters
+        super().__init__(fname, encoding='utf8')
+        self.cnv_type = cnv_type
+
+    def parse_line(self, line):
+        row_dict = dict(zip(Dbvar.tbx_header, line.split('\t')))
+        # clinical_assertion sometimes can be too long. limit it to no more than 20 items.
+        clinical_assertion = row_dict.get(
+            'clinical_assertion', '').split(';')
+        if len(clinical_assertion) > 20:
+            row_dict['clinical_assertion'] = ';'.join(
+                clinical_assertion[:21]) + ' ...'
+        return [(self.cnv_type, int(row_dict['start']) - 1, int(row_dict['end']), row_dict)]
+
 class Dbvar(object):
     tbx_header = [
         'chrom',
@@ -36,27 +59,32 @@ class Dbvar(object):
         'bin_size'
     ]
 
-    def __init__(self, fname, cnv_type):
+    def __init__(self, fname, cnv_type, in_memory=False):
         self.fname = fname
         self.cnv_type = cnv_type
-        # dbvar has non-ASCII characters
-        self.tbx = pysam.TabixFile(fname, encoding='utf8')
+        self.reader = Dbvar_reader(fname, cnv_type)
+        self.tbx = self.reader.tbx
+        # in memory index for get_count
+        self.index = self.load_index(fname) if in_memory else None
+
+    @staticmethod
+    def load_index(fname) -> Interval_index:
+        chroms, starts, ends, sample_counts = [], [], [], []
+        with gzip.open(fname, 'rt', encoding='utf8') as inf:
+            for line in inf:
+                if line.startswith('#'):
+                    continue
+                row = line.split('\t', 4)
+                chroms.append(row[0])
+                starts.append(int(row[1]))
+                ends.append(int(row[2]))
+                sample_counts.append(int(row[3]))
+        return Interval_index(chroms, starts, ends, sample_count=sample_counts)
 
     def get_records(self, chrom, start, end):
         result = []
-        try:
-            it = self.tbx.fetch(chrom, max(0, start-1), end)
-        except ValueError:
-            return result
-        for line in it:
-            row_dict = dict(zip(self.tbx_header, line.split('\t')))
-            # clinical_assertion sometimes can be too long. limit it to no more than 20 items.
-            clinical_assertion = row_dict.get(
-                'clinical_assertion', '').split(';')
-            if len(clinical_assertion) > 20:
-                row_dict['clinical_assertion'] = ';'.join(
-                    clinical_assertion[:21]) + ' ...'
-            interval = Interval_base(
+        for row_dict in self.reader.fetch(chrom, max(0, start-1), end, self.cnv_type):
+            interval = Annotated_interval(
                 row_dict['chrom'],
                 int(row_dict['start']),
                 int(row_dict['end'])
@@ -75,6 +103,9 @@ class Dbvar(object):
         '''
         dbvar doesn't give freq. give count instead
         '''
+        if self.index is not None:
+            records = self.index.get_matches(interval.chrom, interval.start, interval.end, distance_cutoff)
+            return int(records['sample_count'].sum())
         records = self.get_records(interval.chrom, interval.start, interval.end)
         
         records = list(filter(lambda record: record.distance <= distance_cutoff, records ))
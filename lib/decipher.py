@@ -2,8 +2,31 @@
 parse decipher
 return an Interval instance, and a dictionary for later annotation
 '''
-import pysam
+import gzip
 from lib import Interval_base
+from lib.interval import Annotated_interval
+from lib.interval_index import Interval_index
+from lib.tabix_reader import Tabix_reader
+
+
+class Decipher_reader(Tabix_reader):
+    '''
+    each row might have both deletions and duplications, so it can go to both LOSS and GAIN
+    '''
+    def parse_line(self, line):
+        row_dict = dict(zip(Decipher.tbx_header, line.split('\t')))
+        for key in ('deletion_observations', 'duplication_observations', 'observations', 'sample_size'):
+            row_dict[key] = int(row_dict[key])
+        for key in ('deletion_standard_error', 'duplication_standard_error', 'deletion_frequency', 'duplication_frequency', 'frequency', 'standard_error'):
+            row_dict[key] = float(row_dict[key])
+        result = []
+        tbx_start = int(row_dict['start']) - 1
+        tbx_end = int(row_dict['end'])
+        if row_dict['deletion_observations'] > 0:
+            result.append(('LOSS', tbx_start, tbx_end, row_dict))
+        if row_dict['duplication_observations'] > 0:
+            result.append(('GAIN', tbx_start, tbx_end, row_dict))
+        return result
 
 
 class Decipher(object):
@@ -37,63 +60,70 @@ class Decipher(object):
         'study',
     ]
 
-    def __init__(self, fname, cnv_type):
+    def __init__(self, fname, cnv_type, in_memory=False, reader=None):
         self.fname = fname
-        self.tbx = pysam.TabixFile(fname)
+        # LOSS and GAIN come from the same file, so a reader can be shared
+        self.reader = reader if reader is not None else Decipher_reader(fname)
+        self.tbx = self.reader.tbx
         self.cnv_type = cnv_type
+        # in memory index for get_freq
+        self.index = self.load_index(fname, cnv_type) if in_memory else None
+
+    @classmethod
+    def load_index(cls, fname, cnv_type) -> Interval_index:
+        observations_key = {
+            'LOSS': 'deletion_observations',
+            'GAIN': 'duplication_observations',
+        }[cnv_type]
+        chroms, starts, ends, sample_counts, sample_sizes = [], [], [], [], []
+        with gzip.open(fname, 'rt') as inf:
+            for line in inf:
+                if line.startswith('#') or line.startswith(cls.tbx_header[0]):
+                    continue
+                row_dict = dict(zip(cls.tbx_header, line.split('\t')))
+                observations = int(row_dict[observations_key])
+                if observations <= 0:
+                    continue
+                chroms.append(row_dict['chrom'])
+                starts.append(int(row_dict['start']))
+                ends.append(int(row_dict['end']))
+                sample_counts.append(observations)
+                sample_sizes.append(int(row_dict['sample_size']))
+        return Interval_index(chroms, starts, ends, sample_count=sample_counts, sample_size=sample_sizes)
 
     def get_records(self, chrom, start, end):
         result = []
-        try:
-            it = self.tbx.fetch(chrom, max(0, start-1), end)
-        except ValueError:
-            return result
-
-        for line in it:
-            row_dict = dict(zip(self.tbx_header, line.split('\t')))
-            for key in ('deletion_observations', 'duplication_observations', 'observations', 'sample_size'):
-                row_dict[key] = int(row_dict[key])
-            for key in ('deletion_standard_error', 'duplication_standard_error', 'deletion_frequency', 'duplication_frequency', 'frequency', 'standard_error'):
-                row_dict[key] = float(row_dict[key])
-            # note that each row might have both deletions and duplications
-
-            if row_dict['deletion_observations'] > 0 and self.cnv_type == 'LOSS':
-                interval = Interval_base(
-                    row_dict['chrom'],
-                    int(row_dict['start']),
-                    int(row_dict['end'])
-                )
-                interval.annotation_header = self.annotation_header
-                interval.cnv_type = 'LOSS'
-                interval.sample_size = row_dict['sample_size']
+        for row_dict in self.reader.fetch(chrom, max(0, start-1), end, self.cnv_type):
+            interval = Annotated_interval(
+                row_dict['chrom'],
+                int(row_dict['start']),
+                int(row_dict['end'])
+            )
+            interval.annotation_header = self.annotation_header
+            interval.cnv_type = self.cnv_type
+            interval.sample_size = row_dict['sample_size']
+            if self.cnv_type == 'LOSS':
                 interval.sample_count = row_dict['deletion_observations']
                 interval.frequency = row_dict['deletion_frequency']
                 interval.standard_error = row_dict['deletion_standard_error']
-                interval.type = row_dict['type']
-                interval.study = row_dict['study']
-                interval.distance = interval.get_distance(
-                    interval, Interval_base(chrom, start, end))
-                result.append(interval)
-            if row_dict['duplication_observations'] > 0 and self.cnv_type == 'GAIN':
-                interval = Interval_base(
-                    row_dict['chrom'],
-                    int(row_dict['start']),
-                    int(row_dict['end'])
-                )
-                interval.annotation_header = self.annotation_header
-                interval.cnv_type = 'GAIN'
-                interval.sample_size = row_dict['sample_size']
+            else:
                 interval.sample_count = row_dict['duplication_observations']
                 interval.frequency = row_dict['duplication_frequency']
                 interval.standard_error = row_dict['duplication_standard_error']
-                interval.type = row_dict['type']
-                interval.study = row_dict['study']
-                interval.distance = interval.get_distance(
-                    interval, Interval_base(chrom, start, end))
-                result.append(interval)
+            interval.type = row_dict['type']
+            interval.study = row_dict['study']
+            interval.distance = interval.get_distance(
+                interval, Interval_base(chrom, start, end))
+            result.append(interval)
         return result
 
     def get_freq(self, interval:Interval_base, distance_cutoff:float) -> float:
+        if self.index is not None:
+            records = self.index.get_matches(interval.chrom, interval.start, interval.end, distance_cutoff)
+            an = int(records['sample_size'].sum())
+            if an:
+                return int(records['sample_count'].sum()) / an
+            return 0
         records = self.get_records(interval.chrom, interval.start, interval.end)
         records = list(filter(lambda record: record.distance <= distance_cutoff, records ))
         an = sum([int(record.sample_size) for record in records])
@@ -3,16 +3,27 @@ parse gnomad
 return an Interval instance, and a dictionary for later annotation
 Note that the file has all sorts of SVs.
 '''
+import os
 import re
+import functools
 import gzip
-import pysam
-from lib import Interval_base
+import json
+import numpy as np
+from lib import Interval_base, utils
+from lib.interval import Annotated_interval
+from lib.interval_index import Interval_index
+from lib.tabix_reader import Tabix_reader
+
+# bump when compile_sidecar changes, to rebuild sidecars
+SIDECAR_VERSION = 2
 
 
 class Gnomad(object):
+    # END is exposed as the 3rd column, see README
     tbx_header = [
         'chrom',
         'start',
+        'end',
         'ID',
         'ref',
         'alt',
@@ -92,56 +103,30 @@ class Gnomad(object):
         'EAS',
     ]
 
-    def __init__(self, fname, cnv_type):
+    # svtype codes in the sidecar
+    sidecar_types = [
+        'LOSS',
+        'GAIN',
+        'INV',
+        'MCNV',
+    ]
+
+    def __init__(self, fname, cnv_type, sidecar=None, reader=None):
         self.fname = fname
-        self.tbx = pysam.TabixFile(fname)
+        # all types come from the same file, so a reader can be shared
+        self.reader = reader if reader is not None else Gnomad_reader(fname)
+        self.tbx = self.reader.tbx
         self.cnv_type = cnv_type
-        # get info types
-        # note that since the file doesn't contain genotype information
-        # Number should only be one of ('.', '0', '1', 'A')
-        allowed_info_types = {'.', '0', '1', 'A'}
-        info_types = {}
-        with gzip.open(fname, 'rt') as inf:
-            for line in inf:
-                if not line.startswith('##'):
-                    break
-                if line.startswith('##INFO'):
-                    fields = line.split('<', 1)[1].split(',')
-                    key = None
-                    val = None
-                    for field in fields:
-                        if '=' in field:
-                            field_key, field_val = field.split('=')
-                            if field_key == 'ID':
-                                key = field_val
-                            elif field_key == 'Number':
-                                if field_val not in allowed_info_types:
-                                    raise ValueError(
-                                        f"invalid Number:{field_val} for info field {field_key}")
-                                val = field_val
-                    if key is not None and val is not None:
-                        info_types[key] = val
-        self.info_types = info_types
+        self.info_types = self.reader.info_types
+        # compiled records for get_freq, see compile_sidecar
+        self.index = load_sidecar(fname, sidecar) if sidecar is not None else None
 
     def get_records(self, chrom, start, end):
         result = []
-        try:
-            it = self.tbx.fetch(chrom, max(0, start-1), end)
-        except ValueError:
-            return result
-        for line in it:
-            row_dict = dict(zip(self.tbx_header, line.split('\t')))
-            info = self.parse_info(row_dict['info'])
-            
-            # translate svtype from del/dup to loss/gain
-            svtype = {
-                'DEL': 'LOSS',
-                'DUP': 'GAIN',
-            }.get(info['SVTYPE'], info['SVTYPE'])
-            if self.cnv_type != svtype:
-                continue
-            
-            interval = Interval_base(
+        for row_dict, info in self.reader.fetch(chrom, max(0, start-1), end, self.cnv_type):
+            # the MCNV branch splits values, so leave the cached info intact
+            info = dict(info)
+            interval = Annotated_interval(
                 row_dict['chrom'],
                 int(row_dict['start']),
                 int(info['END'])
@@ -165,68 +150,8 @@ class Gnomad(object):
                 for key in info:
                     if self.info_types[key] == 'A':
                         info[key] = info[key].split(',')
-                AC = {
-                    'AC': 0,
-                    'FEMALE_AC': 0,
-                    'MALE_AC': 0,
-                }
-                for pop in self.pops:
-                    for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
-                        AC[f"{pop}_{suffix}"] = 0
-
                 alts = row_dict['alt'].split(',')
-                for ind in range(len(alts)):
-                    cnv_number = int(
-                        re.search(r'^<CN=(\d+)>$', alts[ind]).group(1))
-                    if self.cnv_type == 'LOSS':
-                        # LOSS
-                        if (chrom == 'X' and cnv_number == 0):
-                            AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
-                            AC['MALE_AC'] += int(info['MALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                        elif chrom == 'X' and cnv_number == 1:
-                            AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'FEMALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                        elif chrom == 'Y' and cnv_number == 0:
-                            AC['MALE_AC'] += int(info['MALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'MALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                        elif cnv_number < 2 and chrom not in ('X', 'Y'):
-                            AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
-                            AC['MALE_AC'] += int(info['MALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                    elif self.cnv_type == 'GAIN':
-                        if chrom == 'X' and cnv_number == 2:
-                            AC['MALE_AC'] += int(info['MALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'MALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                        elif chrom == 'Y' and cnv_number == 1:
-                            AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'FEMALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                        elif (chrom == 'Y' and cnv_number > 1) or cnv_number > 2:
-                            AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
-                            AC['MALE_AC'] += int(info['MALE_AC'][ind])
-                            for pop in self.pops:
-                                for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
-                                    pop_key = f"{pop}_{suffix}"
-                                    AC[pop_key] += int(info[pop_key][ind])
-                    else:
-                        raise ValueError(f"cnv type invalid: {self.cnv_type}")
+                AC = self.get_mcnv_ac(chrom, alts, info, self.cnv_type)
                 AC['AC'] = AC['FEMALE_AC'] + AC['MALE_AC']
                 interval.AC = AC['AC']
                 interval.FEMALE_AC = AC['FEMALE_AC']
@@ -261,7 +186,143 @@ class Gnomad(object):
             result.append(interval)
         return result
 
-    def parse_info(self, info_raw):
+    @classmethod
+    def get_mcnv_ac(cls, chrom, alts, info, cnv_type):
+        '''
+        Sum up allele counts of the multiallelic (MCNV) alts that amount to a cnv_type on chrom.
+        Allele specific (Number=A) fields in info are expected to be split into lists
+        '''
+        AC = {
+            'AC': 0,
+            'FEMALE_AC': 0,
+            'MALE_AC': 0,
+        }
+        for pop in cls.pops:
+            for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
+                AC[f"{pop}_{suffix}"] = 0
+
+        for ind in range(len(alts)):
+            cnv_number = int(
+                re.search(r'^<CN=(\d+)>$', alts[ind]).group(1))
+            if cnv_type == 'LOSS':
+                # LOSS
+                if (chrom == 'X' and cnv_number == 0):
+                    AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
+                    AC['MALE_AC'] += int(info['MALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+                elif chrom == 'X' and cnv_number == 1:
+                    AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'FEMALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+                elif chrom == 'Y' and cnv_number == 0:
+                    AC['MALE_AC'] += int(info['MALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'MALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+                elif cnv_number < 2 and chrom not in ('X', 'Y'):
+                    AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
+                    AC['MALE_AC'] += int(info['MALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+            elif cnv_type == 'GAIN':
+                if chrom == 'X' and cnv_number == 2:
+                    AC['MALE_AC'] += int(info['MALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'MALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+                elif chrom == 'Y' and cnv_number == 1:
+                    AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'FEMALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                elif (chrom == 'Y' and cnv_number > 1) or cnv_number > 2:
+                    AC['FEMALE_AC'] += int(info['FEMALE_AC'][ind])
+                    AC['MALE_AC'] += int(info['MALE_AC'][ind])
+                    for pop in cls.pops:
+                        for suffix in ('AC', 'FEMALE_AC', 'MALE_AC'):
+                            pop_key = f"{pop}_{suffix}"
+                            AC[pop_key] += int(info[pop_key][ind])
+            else:
+                raise ValueError(f"cnv type invalid: {cnv_type}")
+        return AC
+
+    @staticmethod
+    def translate_svtype(svtype):
+        # translate svtype from del/dup to loss/gain
+        return {
+            'DEL': 'LOSS',
+            'DUP': 'GAIN',
+        }.get(svtype, svtype)
+
+    @classmethod
+    def compile_sidecar(cls, fname, outfile):
+        '''
+        Convert the gnomad file to a numpy structured array, sorted by chrom and start, with
+        the resolved svtype (code in sidecar_types, -1 otherwise), AN and AC of LOSS, GAIN and INV.
+        As in get_records, MCNV records don't count for any cnv_type, so their ACs are left at 0.
+        The fingerprint of fname goes to the sidecar's meta file, see load_sidecar
+        '''
+        records = []
+        with gzip.open(fname, 'rt') as inf:
+            for line in inf:
+                if line.startswith('#'):
+                    continue
+                row_dict = dict(zip(cls.tbx_header, line.rstrip('\n').split('\t')))
+                info = cls.parse_info(row_dict['info'])
+                svtype = cls.translate_svtype(info['SVTYPE'])
+                AC = {
+                    'LOSS': 0,
+                    'GAIN': 0,
+                    'INV': 0,
+                }
+                AN = 0
+                if svtype in AC:
+                    AC[svtype] = int(info['AC'])
+                    AN = int(info['AN'])
+                records.append((
+                    row_dict['chrom'],
+                    int(row_dict['start']),
+                    int(info['END']),
+                    cls.sidecar_types.index(svtype) if svtype in cls.sidecar_types else -1,
+                    AN,
+                    AC['LOSS'],
+                    AC['GAIN'],
+                    AC['INV'],
+                ))
+        records.sort(key=lambda x: (x[0], x[1]))
+        chrom_size = max([len(record[0]) for record in records], default=1)
+        dtype = [
+            ('chrom', f'U{chrom_size}'),
+            ('start', 'i8'),
+            ('end', 'i8'),
+            ('svtype', 'i1'),
+            ('AN', 'i8'),
+            ('AC_LOSS', 'i8'),
+            ('AC_GAIN', 'i8'),
+            ('AC_INV', 'i8'),
+        ]
+        # write through a file object, so that np.save won't append .npy.
+        # Files are moved in place, as annotation workers might compile at the same time
+        tmp_file = f"{outfile}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as outf:
+            np.save(outf, np.array(records, dtype=dtype))
+        os.replace(tmp_file, outfile)
+        # meta goes last, so a partly written sidecar is not picked up
+        with open(tmp_file, 'wt') as outf:
+            json.dump({'version': SIDECAR_VERSION, 'fingerprint': utils.file_fingerprint(fname)}, outf)
+        os.replace(tmp_file, get_sidecar_meta(outfile))
+
+    @staticmethod
+    def parse_info(info_raw):
         info = {}
         for info_field in info_raw.split(';'):
             if '=' in info_field:
@@ -272,6 +333,14 @@ class Gnomad(object):
         return info
 
     def get_freq(self, interval:Interval_base, distance_cutoff:float) -> float:
+        if self.index is not None:
+            records = self.index.get_matches(interval.chrom, interval.start, interval.end, distance_cutoff)
+            # as in get_records, MCNV records don't count for any cnv_type
+            is_type = records['svtype'] == self.sidecar_types.index(self.cnv_type)
+            an = int(records['AN'][is_type].sum())
+            if an:
+                return int(records[f"AC_{self.cnv_type}"][is_type].sum()) / an
+            return 0
         records = self.get_records(interval.chrom, interval.start, interval.end)
         records = list(filter(lambda record: record.distance <= distance_cutoff, records ))
         an = sum([int(record.AN) for record in records])
@@ -281,6 +350,72 @@ class Gnomad(object):
         
         return 0
 
+class Gnomad_reader(Tabix_reader):
+    '''
+    records are bucketed by translated svtype. Header is read once for all types.
+    '''
+    def __init__(self, fname):
+        super().__init__(fname)
+        self.info_types = read_info_types(fname)
+
+    def parse_line(self, line):
+        row_dict = dict(zip(Gnomad.tbx_header, line.split('\t')))
+        info = Gnomad.parse_info(row_dict['info'])
+        svtype = Gnomad.translate_svtype(info['SVTYPE'])
+        return [(svtype, int(row_dict['start']) - 1, int(row_dict['end']), (row_dict, info))]
+
+def read_info_types(fname):
+    # get info types
+    # note that since the file doesn't contain genotype information
+    # Number should only be one of ('.', '0', '1', 'A')
+    allowed_info_types = {'.', '0', '1', 'A'}
+    info_types = {}
+    with gzip.open(fname, 'rt') as inf:
+        for line in inf:
+            if not line.startswith('##'):
+                break
+            if line.startswith('##INFO'):
+                fields = line.split('<', 1)[1].split(',')
+                key = None
+                val = None
+                for field in fields:
+                    if '=' in field:
+                        field_key, field_val = field.split('=')
+                        if field_key == 'ID':
+                            key = field_val
+                        elif field_key == 'Number':
+                            if field_val not in allowed_info_types:
+                                raise ValueError(
+                                    f"invalid Number:{field_val} for info field {field_key}")
+                            val = field_val
+                if key is not None and val is not None:
+                    info_types[key] = val
+    return info_types
+
+def get_sidecar_meta(sidecar) -> str:
+    return f"{sidecar}.json"
+
+def is_sidecar_current(fname, sidecar) -> bool:
+    '''
+    whether the sidecar was compiled from fname as it is now, by this version of compile_sidecar
+    '''
+    meta_file = get_sidecar_meta(sidecar)
+    if not os.path.isfile(sidecar) or not os.path.isfile(meta_file):
+        return False
+    with open(meta_file, 'rt') as inf:
+        meta = json.load(inf)
+    return meta['version'] == SIDECAR_VERSION and meta['fingerprint'] == utils.file_fingerprint(fname)
+
+@functools.lru_cache(maxsize=None)
+def load_sidecar(fname, sidecar) -> Interval_index:
+    '''
+    memory-map the compiled gnomad records, (re)compiling them if missing or fname changed.
+    Cached, so that all cnv_types share one index.
+    '''
+    if not is_sidecar_current(fname, sidecar):
+        Gnomad.compile_sidecar(fname, sidecar)
+    return Interval_index.from_records(np.load(sidecar, mmap_mode='r'))
+
 def check_int(s):
     s = str(s)
     if s[0] in ('-', '+'):
@@ -0,0 +1,227 @@
+'''
+in-memory index of gene, exon and CDS features of a GTF file
+Features are held per (chrom, feature) in numpy arrays sorted by start, with interned
+gene ids and biotypes, so overlaps of a batch of SVs are found with a few vectorized calls.
+Semantics follow utils._get_overlap and utils.get_protein_coding_disrupted_genes.
+The index can be saved as a directory of memory-mappable .npy files, see Gtf_index.cached.
+'''
+import gzip
+import json
+import os
+import shutil
+import numpy as np
+import sqlalchemy as sa
+from typing import Dict, List, Sequence, Set
+from lib import Types, utils
+from lib.tabix_reader import Tabix_reader
+
+# bump when the cache layout changes
+CACHE_VERSION = 1
+
+
+class Gtf_index(object):
+    features = ('gene', 'exon', 'CDS')
+
+    def __init__(self, arrays: Dict, gene_ids: List[str], gene_names: List[str], biotypes: List[str]):
+        # arrays[(chrom, feature)] = {'start', 'end', 'max_end', 'gene', 'biotype'}
+        self.arrays = arrays
+        self.gene_ids = gene_ids
+        self.gene_names = gene_names
+        self.biotypes = biotypes
+        self.protein_coding = biotypes.index('protein_coding') if 'protein_coding' in biotypes else -1
+        # Gene.id
+        self.gene_numbers = [int(i.lstrip('ENSG')) for i in gene_ids]
+
+    @classmethod
+    def from_file(cls, fname):
+        genes = {}
+        gene_ids, gene_names = [], []
+        biotypes = {}
+        rows = {}
+        with gzip.open(fname, 'rt') as inf:
+            for line in inf:
+                if line.startswith('#'):
+                    continue
+                row = line.rstrip().split('\t')
+                if row[2] not in cls.features:
+                    continue
+                info = utils.parse_gtf_info(row[-1])
+                if info['gene_id'] not in genes:
+                    genes[info['gene_id']] = len(gene_ids)
+                    gene_ids.append(info['gene_id'])
+                    gene_names.append(info.get('gene_name'))
+                biotype = info.get('transcript_biotype', info['gene_biotype'])
+                biotypes.setdefault(biotype, len(biotypes))
+                rows.setdefault((row[0], row[2]), []).append(
+                    (int(row[3]), int(row[4]), genes[info['gene_id']], biotypes[biotype])
+                )
+        arrays = {}
+        for key, val in rows.items():
+            val = np.array(val, dtype=np.int64)
+            val = val[np.argsort(val[:, 0], kind='stable')]
+            arrays[key] = {
+                'start': val[:, 0],
+                'end': val[:, 1],
+                'max_end': np.maximum.accumulate(val[:, 1]),
+                'gene': val[:, 2].astype(np.int32),
+                'biotype': val[:, 3].astype(np.int32),
+            }
+        return cls(arrays, gene_ids, gene_names, sorted(biotypes, key=biotypes.get))
+
+    @classmethod
+    def cached(cls, fname, cache_dir):
+        '''
+        load the index from cache_dir, (re)building it if the GTF file changed
+        '''
+        fingerprint = utils.file_fingerprint(fname)
+        meta_file = os.path.join(cache_dir, 'meta.json')
+        if os.path.isfile(meta_file):
+            with open(meta_file, 'rt') as inf:
+                meta = json.load(inf)
+            if meta['version'] == CACHE_VERSION and meta['fingerprint'] == fingerprint:
+                return cls.load(cache_dir, meta)
+        index = cls.from_file(fname)
+        index.save(cache_dir, fingerprint)
+        return index
+
+    def save(self, cache_dir, fingerprint):
+        '''
+        write the cache to a temporary directory, and move it in place of cache_dir,
+        so an interrupted save doesn't leave a mix of old and new files
+        '''
+        tmp_dir = f"{cache_dir.rstrip(os.sep)}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        keys = []
+        offset = 0
+        for (chrom, feature), arrays in self.arrays.items():
+            keys.append([chrom, feature, offset, offset + len(arrays['start'])])
+            offset += len(arrays['start'])
+        for column in ('start', 'end', 'max_end', 'gene', 'biotype'):
+            np.save(os.path.join(tmp_dir, f"{column}.npy"),
+                    np.concatenate([arrays[column] for arrays in self.arrays.values()]))
+        np.save(os.path.join(tmp_dir, 'gene_ids.npy'), np.array(self.gene_ids))
+        np.save(os.path.join(tmp_dir, 'gene_names.npy'), np.array([name or '' for name in self.gene_names]))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'wt') as outf:
+            json.dump({
+                'version': CACHE_VERSION,
+                'fingerprint': fingerprint,
+                'keys': keys,
+                'biotypes': self.biotypes,
+            }, outf)
+        # a directory can't replace a non empty one, so the old cache is moved aside first.
+        # Indexes loaded from it keep their memory maps
+        old_dir = f"{cache_dir.rstrip(os.sep)}.{os.getpid()}.old"
+        if os.path.isdir(cache_dir):
+            os.replace(cache_dir, old_dir)
+        try:
+            os.replace(tmp_dir, cache_dir)
+        except OSError:
+            # another process put its cache in place first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, cache_dir, meta):
+        columns = {
+            column: np.load(os.path.join(cache_dir, f"{column}.npy"), mmap_mode='r')
+            for column in ('start', 'end', 'max_end', 'gene', 'biotype')
+        }
+        arrays = {}
+        for chrom, feature, lo, hi in meta['keys']:
+            arrays[(chrom, feature)] = {column: val[lo:hi] for column, val in columns.items()}
+        gene_ids = np.load(os.path.join(cache_dir, 'gene_ids.npy')).tolist()
+        gene_names = [name or None for name in np.load(os.path.join(cache_dir, 'gene_names.npy')).tolist()]
+        return cls(arrays, gene_ids, gene_names, meta['biotypes'])
+
+    def get_overlaps(self, chroms: Sequence[str], starts: Sequence[int], ends: Sequence[int], feature: str, gene_id: bool = True, protein_coding_gene: bool = True) -> List[Set[str]]:
+        '''
+        genes with a feature overlapping each (chrom, start, end), as tabix would fetch them
+        '''
+        result = [set() for _ in chroms]
+        names = self.gene_ids if gene_id else self.gene_names
+        by_chrom = {}
+        for ind, chrom in enumerate(chroms):
+            # GTF contigs have no chr prefix
+            chrom = chrom.lstrip('chr')
+            if chrom == 'M':
+                chrom = 'MT'
+            by_chrom.setdefault(chrom, []).append(ind)
+        for chrom, inds in by_chrom.items():
+            arrays = self.arrays.get((chrom, feature))
+            if arrays is None:
+                continue
+            inds = np.array(inds)
+            q_starts = np.asarray(starts, dtype=np.int64)[inds]
+            q_ends = np.asarray(ends, dtype=np.int64)[inds]
+            # 1-based features overlap 0-based [start, end) if feature start <= end and feature end > start
+            lo = np.searchsorted(arrays['max_end'], q_starts, side='right')
+            hi = np.searchsorted(arrays['start'], q_ends, side='right')
+            hi = np.where(q_ends > q_starts, np.maximum(hi, lo), lo)
+            counts = hi - lo
+            if not counts.sum():
+                continue
+            # flatten candidates of all queries
+            query_of = np.repeat(np.arange(len(inds)), counts)
+            candidates = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.repeat(lo, counts)
+            mask = arrays['end'][candidates] > q_starts[query_of]
+            if protein_coding_gene:
+                mask &= arrays['biotype'][candidates] == self.protein_coding
+            for query, gene in zip(query_of[mask].tolist(), arrays['gene'][candidates[mask]].tolist()):
+                result[inds[query]].add(names[gene])
+        return result
+
+    def get_protein_coding_disrupted_genes(self, intervals: Sequence, feature: str = 'exon', gene_id: bool = True, protein_coding_gene: bool = True) -> List[List[str]]:
+        '''
+        batch version of utils.get_protein_coding_disrupted_genes, with svtype of each interval
+        '''
+        if feature not in ('exon', 'CDS'):
+            raise ValueError(f"feature has to be iether exon or CDS, got {feature}")
+        chroms = [i.chrom for i in intervals]
+        starts = np.array([i.start for i in intervals], dtype=np.int64)
+        ends = np.array([i.end for i in intervals], dtype=np.int64)
+        covered_features = self.get_overlaps(chroms, starts, ends, feature, gene_id, protein_coding_gene)
+        start_genes = self.get_overlaps(chroms, starts, starts + 1, 'gene', gene_id, protein_coding_gene)
+        end_genes = self.get_overlaps(chroms, ends, ends + 1, 'gene', gene_id, protein_coding_gene)
+        result = []
+        for ind, interval in enumerate(intervals):
+            covered_feature = covered_features[ind]
+            if not covered_feature:
+                result.append([])
+            elif interval.svtype == Types.SVtype.LOSS:
+                result.append(list(covered_feature))
+            elif interval.svtype == Types.SVtype.INV:
+                result.append(list(covered_feature & (start_genes[ind] | end_genes[ind])))
+            elif interval.svtype == Types.SVtype.GAIN:
+                result.append(list(covered_feature & start_genes[ind] & end_genes[ind]))
+            else:
+                result.append([])
+        return result
+
+
+class Gtf_reader(Tabix_reader):
+    '''
+    raw lines, for utils._get_overlap through merge_join.Swept_reader
+    '''
+    def parse_line(self, line):
+        row = line.split('\t', 5)
+        return [(None, int(row[3]) - 1, int(row[4]), line)]
+
+
+def get_cache_dir(config):
+    '''
+    gtf_cache in config, or next to a sqlite database
+    '''
+    if config.get('gtf_cache'):
+        return config['gtf_cache']
+    database = sa.engine.make_url(config['db']).database
+    if database and database != ':memory:':
+        return f"{database}.gtf_cache"
+    return None
+
+
+def load(config) -> Gtf_index:
+    cache_dir = get_cache_dir(config)
+    if cache_dir is None:
+        return Gtf_index.from_file(config['gene_tbx'])
+    return Gtf_index.cached(config['gene_tbx'], cache_dir)
@@ -1,18 +1,45 @@
 # given intervals, produce groups of intervals, where each member of a group overlaps with each other.
+import math
 import numpy as np
 import copy
+from typing import List, Sequence
+from lib import Types
+from scipy import sparse
 from scipy.spatial import distance
 from sklearn.cluster import DBSCAN
 
+# groups from this size on are clustered on a sparse graph, see Group.cluster
+SPARSE_CLUSTER_SIZE = 1000
+
 
 class Interval_base(object):
+    '''
+    Intervals are compared on sort_key, (chrom, start, end), computed once.
+    Slotted, so subclasses carrying arbitrary attributes should derive from Annotated_interval.
+    '''
+    __slots__ = ('chrom', 'start', 'end', 'size', 'groups', 'sort_key', 'chrom_code', '_name')
+
     def __init__(self, chrom, start, end):
         self.chrom = chrom
         self.start = start
         self.end = end
         self.size = end - start
         self.groups = []
-        self.name = f'{chrom}-{start}-{end}'
+        self.sort_key = (chrom, start, end)
+        # index in Types.CHROMOSOMES, -1 for other contigs
+        self.chrom_code = Types.CHROMOSOME_CODES.get(chrom, -1)
+        self._name = None
+
+    @property
+    def name(self):
+        # made on first use, as most intervals (e.g. of groups) are never named
+        if self._name is None:
+            self._name = f'{self.chrom}-{self.start}-{self.end}'
+        return self._name
+
+    @name.setter
+    def name(self, name):
+        self._name = name
 
     @staticmethod
     def overlap(this, other):
@@ -35,51 +62,19 @@ class Interval_base(object):
         return None
 
     def __eq__(self, other):
-        return ((self.chrom, self.start, self.end) == (other.chrom, other.start, other.end))
+        return self.sort_key == other.sort_key
 
     def __lt__(self, other):
-        if self.chrom < other.chrom:
-            return True
-        if self.chrom == other.chrom:
-            if self.start < other.start:
-                return True
-            if self.start == other.start:
-                if self.end < other.end:
-                    return True
-        return False
+        return self.sort_key < other.sort_key
 
     def __le__(self, other):
-        if self.chrom < other.chrom:
-            return True
-        if self.chrom == other.chrom:
-            if self.start < other.start:
-                return True
-            if self.start == other.start:
-                if self.end <= other.end:
-                    return True
-        return False
+        return self.sort_key <= other.sort_key
 
     def __gt__(self, other):
-        if self.chrom > other.chrom:
-            return True
-        if self.chrom == other.chrom:
-            if self.start > other.start:
-                return True
-            if self.start == other.start:
-                if self.end > other.end:
-                    return True
-        return False
+        return self.sort_key > other.sort_key
 
     def __ge__(self, other):
-        if self.chrom > other.chrom:
-            return True
-        if self.chrom == other.chrom:
-            if self.start > other.start:
-                return True
-            if self.start == other.start:
-                if self.end >= other.end:
-                    return True
-        return False
+        return self.sort_key >= other.sort_key
 
     def __repr__(self):
         return self.name
@@ -103,7 +98,7 @@ class Interval_base(object):
         groups.append(new_group)
         group_n = 0
         for interval in sorted_intervals:
-            while group_n < len(groups) and interval in groups[group_n].intervals:
+            while group_n < len(groups) and interval.sort_key in groups[group_n].keys:
                 group_n += 1
             while group_n < len(groups) and groups[group_n].does_interval_belong_to_group(interval):
                 groups[group_n].add_interval(interval)
@@ -111,76 +106,276 @@ class Interval_base(object):
         return groups
 
 
+class Annotated_interval(Interval_base):
+    '''
+    interval with arbitrary attributes, e.g. a record of gnomad, dbvar or decipher
+    '''
+
+
+class Interval_array(object):
+    '''
+    Intervals held column-wise: chrom codes (index in self.chroms, which is sorted),
+    starts and ends, for batch distance and overlap with the semantics of Interval_base.
+    Items are the intervals it was made from, or new Interval_base instances.
+    '''
+    def __init__(self, chroms: List[str], starts: Sequence[int], ends: Sequence[int], intervals: List = None):
+        chroms, chrom_codes = np.unique(np.array(chroms, dtype=str), return_inverse=True)
+        self.chroms: List[str] = chroms.tolist()
+        self.chrom_codes = chrom_codes.reshape(-1).astype(np.int32)
+        self.starts = np.asarray(starts, dtype=np.int64)
+        self.ends = np.asarray(ends, dtype=np.int64)
+        self.sizes = self.ends - self.starts
+        self.intervals = intervals
+        # order of starts, for get_candidates
+        self._by_start = None
+        self._sorted_starts = None
+
+    @classmethod
+    def from_intervals(cls, intervals: List[Interval_base]):
+        return cls(
+            [i.chrom for i in intervals],
+            [i.start for i in intervals],
+            [i.end for i in intervals],
+            intervals=list(intervals),
+        )
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, ind):
+        if self.intervals is not None:
+            return self.intervals[ind]
+        return Interval_base(self.chroms[self.chrom_codes[ind]], int(self.starts[ind]), int(self.ends[ind]))
+
+    def __iter__(self):
+        return (self[ind] for ind in range(len(self)))
+
+    @property
+    def names(self) -> List[str]:
+        return [f'{self.chroms[c]}-{s}-{e}' for c, s, e in zip(self.chrom_codes.tolist(), self.starts.tolist(), self.ends.tolist())]
+
+    def get_chrom_mask(self, chrom: str) -> np.ndarray:
+        if chrom not in self.chroms:
+            return np.zeros(len(self), dtype=bool)
+        return self.chrom_codes == self.chroms.index(chrom)
+
+    def get_sort_order(self) -> np.ndarray:
+        '''
+        indices in order of sort_key, as sorted() of the intervals
+        '''
+        return np.lexsort((self.ends, self.starts, self.chrom_codes))
+
+    def get_overlaps(self, interval: Interval_base) -> np.ndarray:
+        '''
+        Interval_base.overlap(i, interval) for each i
+        '''
+        overlap_size = np.maximum(self.ends, interval.end) - np.minimum(self.starts, interval.start)
+        return self.get_chrom_mask(interval.chrom) & (self.sizes + interval.size > overlap_size)
+
+    def get_distances(self, interval: Interval_base, inds: np.ndarray = None) -> np.ndarray:
+        '''
+        Interval_base.get_distance(i, interval) for each i (of inds if given), nan for other chroms
+        (None in get_distance) or an empty merged interval (ZeroDivisionError in get_distance)
+        '''
+        if inds is None:
+            inds = slice(None)
+        starts = self.starts[inds]
+        ends = self.ends[inds]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = 1 - (np.minimum(ends, interval.end) - np.maximum(starts, interval.start)) / \
+                (np.maximum(ends, interval.end) - np.minimum(starts, interval.start))
+        distances[~self.get_chrom_mask(interval.chrom)[inds]] = np.nan
+        return distances
+
+    def get_candidates(self, ind: int, distance: float) -> np.ndarray:
+        '''
+        indices of intervals that can be within distance (< 1) of interval ind, in order of start.
+        1 - shared / merged size <= distance needs the smaller size to be at least (1 - distance)
+        of the larger, and starts at most distance / (1 - distance) sizes apart.
+        The bounds are loosened a little, so float rounding can't drop an interval.
+        '''
+        if self._by_start is None:
+            self._by_start = np.argsort(self.starts, kind='stable')
+            self._sorted_starts = self.starts[self._by_start]
+        ratio = 1 - distance
+        start = self.starts[ind]
+        size = self.sizes[ind]
+        window = distance / ratio * size * (1 + 1e-9) + 1
+        lo = np.searchsorted(self._sorted_starts, start - window, side='left')
+        hi = np.searchsorted(self._sorted_starts, start + window, side='right')
+        candidates = self._by_start[lo:hi]
+        sizes = self.sizes[candidates]
+        return candidates[np.minimum(sizes, size) >= ratio * np.maximum(sizes, size) * (1 - 1e-9)]
+
+    def get_radius_graph(self, distance: float) -> sparse.csr_matrix:
+        '''
+        sparse get_distance_matrix of pairs within distance (< 1) of each other (distances of 0
+        stored explicitly), for DBSCAN with a precomputed metric. Memory is O(n * neighbours)
+        '''
+        rows = []
+        cols = []
+        data = []
+        for ind in range(len(self)):
+            candidates = self.get_candidates(ind, distance)
+            starts = self.starts[candidates]
+            ends = self.ends[candidates]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                distances = 1 - (np.minimum(ends, self.ends[ind]) - np.maximum(starts, self.starts[ind])) / \
+                    (np.maximum(ends, self.ends[ind]) - np.minimum(starts, self.starts[ind]))
+            near = distances <= distance
+            rows.append(np.full(near.sum(), ind))
+            cols.append(candidates[near])
+            data.append(distances[near])
+        return sparse.csr_matrix(
+            (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(len(self), len(self)),
+        )
+
+    def get_distance_matrix(self) -> np.ndarray:
+        '''
+        pairwise distances, as interval_distance_for_cdist of (start, size) (chroms are not compared)
+        '''
+        starts = self.starts[:, None]
+        ends = self.ends[:, None]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return 1 - (np.minimum(ends, ends.T) - np.maximum(starts, starts.T)) / \
+                (np.maximum(ends, ends.T) - np.minimum(starts, starts.T))
+
+
 class Group(object):
+    '''
+    Intervals all overlapping the core, the intersection of them.
+    Adding an interval is O(1): the bounds and the integer sums of starts and ends (for mean
+    and stdev) are kept as they go. The interval objects, and the sorting of intervals, are
+    only done when asked for.
+    '''
     def __init__(self):
-        self.intervals = []
+        # in order of addition, see intervals
+        self._intervals = []
+        self._sorted = True
+        # sort_key of intervals, for membership
+        self.keys = set()
         self.chrom = None
         self.loose_start = None
         self.loose_end = None
         self.loose_name = None
         self.core_start = None
         self.core_end = None
-        self.core_name = None
-        self.core_interval = None
-        self.loose_interval = None
-        self.mean_start = None
-        self.mean_end = None
-        self.mean_interval = None
-        self.mean_name = None
-        self.stdev_start = None
-        self.stdev_end = None
+        # number of intervals, sums of starts, ends and their squares
+        self.n = 0
+        self.start_sum = 0
+        self.start_square_sum = 0
+        self.end_sum = 0
+        self.end_square_sum = 0
+
+    @property
+    def intervals(self) -> List:
+        # sorted (stable, as sorting after each addition did)
+        if not self._sorted:
+            self._intervals.sort()
+            self._sorted = True
+        return self._intervals
+
+    @property
+    def core_interval(self):
+        if not self.n:
+            return None
+        return Interval_base(self.chrom, self.core_start, self.core_end)
+
+    @property
+    def loose_interval(self):
+        if not self.n:
+            return None
+        return Interval_base(self.chrom, self.loose_start, self.loose_end)
+
+    @property
+    def mean_start(self):
+        # as int(round(np.mean(starts))): the sum is exact, and so is its division by n
+        if not self.n:
+            return None
+        return int(round(self.start_sum / self.n))
+
+    @property
+    def mean_end(self):
+        if not self.n:
+            return None
+        return int(round(self.end_sum / self.n))
+
+    @property
+    def mean_interval(self):
+        if not self.n:
+            return None
+        return Interval_base(self.chrom, self.mean_start, self.mean_end)
+
+    @staticmethod
+    def _stdev(n, value_sum, square_sum):
+        # population stdev, n**2 * variance being an integer
+        if n < 2:
+            return 0
+        return math.sqrt(n * square_sum - value_sum ** 2) / n
+
+    @property
+    def stdev_start(self):
+        if not self.n:
+            return None
+        return self._stdev(self.n, self.start_sum, self.start_square_sum)
+
+    @property
+    def stdev_end(self):
+        if not self.n:
+            return None
+        return self._stdev(self.n, self.end_sum, self.end_square_sum)
+
+    @property
+    def core_name(self):
+        if not self.n:
+            return None
+        return f'{self.chrom}-{self.core_start}-{self.core_end}'
+
+    @property
+    def mean_name(self):
+        if not self.n:
+            return None
+        return f'{self.chrom}-{self.mean_start}-{self.mean_end}'
 
     def does_interval_belong_to_group(self, interval):
         # None: intervals empty, True: yes, False: no
-        if not self.intervals:
+        if not self.n:
             return None
-
-        return Interval_base.overlap(interval, Interval_base(self.chrom, self.core_start, self.core_end))
+        # Interval_base.overlap with the core interval
+        if interval.chrom != self.chrom:
+            return False
+        overlap_size = max(interval.end, self.core_end) - min(interval.start, self.core_start)
+        return interval.size + self.core_end - self.core_start > overlap_size
 
     def add_interval(self, interval):
-        if self.intervals and not self.does_interval_belong_to_group(interval):
+        if self.n and not self.does_interval_belong_to_group(interval):
             raise ValueError(
                 f"interval: {interval} do not belong to group:{self} ")
-        if self.intervals:
+        if self.n:
             self.loose_end = max(self.loose_end, interval.end)
             self.loose_start = min(self.loose_start, interval.start)
-            self.core_start = max(
-                self.core_start, interval.start)
+            self.core_start = max(self.core_start, interval.start)
             self.core_end = min(self.core_end, interval.end)
-            self.loose_interval = Interval_base(
-                self.chrom, self.loose_start, self.loose_end)
-            self.core_interval = Interval_base(
-                self.chrom, self.core_start, self.core_end)
-            self.mean_start = int(round(np.mean(
-                [i.start for i in self.intervals] + [interval.start])))
-            self.stdev_start = np.std(
-                [i.start for i in self.intervals] + [interval.start])
-            self.mean_end = int(round(np.mean(
-                [i.end for i in self.intervals] + [interval.end])))
-            self.stdev_end = np.std(
-                [i.end for i in self.intervals] + [interval.end])
-            self.mean_interval = Interval_base(
-                self.chrom, self.mean_start, self.mean_end)
+            if self._sorted and interval.sort_key < self._intervals[-1].sort_key:
+                self._sorted = False
         else:
             self.chrom = interval.chrom
-            self.loose_end = self.core_end = self.mean_end = interval.end
-            self.loose_start = self.core_start = self.mean_start = interval.start
-            self.loose_interval = Interval_base(
-                interval.chrom, interval.start, interval.end)
-            self.core_interval = Interval_base(
-                interval.chrom, interval.start, interval.end)
-            self.mean_interval = Interval_base(
-                interval.chrom, interval.start, interval.end)
-            self.stdev_start = self.stdev_end = 0
-        self.core_name = f'{self.chrom}-{self.core_start}-{self.core_end}'
-        self.mean_name = f'{self.chrom}-{self.mean_start}-{self.mean_end}'
-        self.intervals.append(interval)
-        self.intervals.sort()
+            self.loose_end = self.core_end = interval.end
+            self.loose_start = self.core_start = interval.start
+        self.n += 1
+        self.start_sum += interval.start
+        self.start_square_sum += interval.start ** 2
+        self.end_sum += interval.end
+        self.end_square_sum += interval.end ** 2
+        self._intervals.append(interval)
+        self.keys.add(interval.sort_key)
 
     def produce_distance_matrix(self, method=None):
         # use start and size to produce distance matrix
-        if method is None:
-            method = interval_distance_for_cdist
+        if method is None or method is interval_distance_for_cdist:
+            # vectorized interval_distance_for_cdist
+            return Interval_array.from_intervals(self.intervals).get_distance_matrix()
         A = [(i.start, i.size) for i in self.intervals]
 
         return distance.cdist(A, A, method)
@@ -195,25 +390,34 @@ class Group(object):
                      for i in self.intervals]
         return {'mean': np.mean(distances), 'stdev': np.std(distances)}
 
+    def get_labels(self, distance) -> np.ndarray:
+        # DBSCAN labels of intervals, -1 for noise
+        # large groups give DBSCAN the sparse graph of intervals within distance instead of all distances
+        if len(self.intervals) >= SPARSE_CLUSTER_SIZE and distance < 1:
+            D = Interval_array.from_intervals(self.intervals).get_radius_graph(distance)
+        else:
+            D = self.produce_distance_matrix(
+                method=interval_distance_for_cdist)
+        return DBSCAN(eps=distance, min_samples=2, metric='precomputed').fit(D).labels_
+
     def cluster(self, distance):
         # making sub-groups with DBSCAN
         groups = {}
-        D = self.produce_distance_matrix(
-            method=interval_distance_for_cdist)
-        C = DBSCAN(eps=distance, min_samples=2, metric='precomputed').fit(D)
-        for group_index in set(C.labels_):
+        labels = self.get_labels(distance)
+        members = {}
+        for interval_index, group_index in enumerate(labels.tolist()):
+            members.setdefault(group_index, []).append(interval_index)
+        for group_index in set(labels):
             if group_index == -1:
-                for interval_index in [ind for ind in range(len(self.intervals)) if C.labels_[ind] == group_index]:
+                for interval_index in members[group_index]:
                     interval = self.intervals[interval_index]
                     group = Group()
                     group.add_interval(interval)
                     groups[group.core_name] = group
             else:
-                intervals = [self.intervals[interval_index] for interval_index in range(
-                    len(self.intervals)) if C.labels_[interval_index] == group_index]
                 group = Group()
-                for interval in intervals:
-                    group.add_interval(interval)
+                for interval_index in members[group_index]:
+                    group.add_interval(self.intervals[interval_index])
                 groups[group.core_name] = group
 
         return groups
@@ -0,0 +1,73 @@
+'''
+in-memory interval index
+Intervals are held per chromosome in numpy arrays sorted by start,
+together with any number of value columns, e.g. sample_count.
+Lookups mirror a tabix fetch of (start - 1, end) followed by a distance filter.
+'''
+import numpy as np
+from typing import Dict, List
+
+
+class Interval_index(object):
+    def __init__(self, chroms: List[str], starts: List[int], ends: List[int], **columns: List):
+        self.arrays: Dict[str, Dict[str, np.ndarray]] = {}
+        chroms = np.array(chroms, dtype=object)
+        starts = np.array(starts, dtype=np.int64)
+        ends = np.array(ends, dtype=np.int64)
+        columns = {key: np.array(val) for key, val in columns.items()}
+        self.empty = {key: val[:0] for key, val in columns.items()}
+        self.empty.update({'start': starts[:0], 'end': ends[:0], 'max_end': ends[:0]})
+        for chrom in set(chroms):
+            mask = chroms == chrom
+            order = np.argsort(starts[mask], kind='stable')
+            arrays = {
+                'start': starts[mask][order],
+                'end': ends[mask][order],
+            }
+            for key, val in columns.items():
+                arrays[key] = val[mask][order]
+            # records before i can't overlap anything starting after max_end[i]
+            arrays['max_end'] = np.maximum.accumulate(arrays['end'])
+            self.arrays[chrom] = arrays
+
+    @classmethod
+    def from_records(cls, records: np.ndarray):
+        '''
+        records: structured array with chrom, start and end fields, sorted by chrom then start.
+        Columns are kept as views, so a memory-mapped array is not read until queried.
+        '''
+        index = cls.__new__(cls)
+        index.arrays = {}
+        columns = [name for name in records.dtype.names if name != 'chrom']
+        index.empty = {name: records[name][:0] for name in columns}
+        index.empty['max_end'] = records['end'][:0]
+        chroms, firsts = np.unique(records['chrom'], return_index=True)
+        bounds = sorted(firsts.tolist()) + [len(records)]
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            arrays = {name: records[name][lo:hi] for name in columns}
+            arrays['max_end'] = np.maximum.accumulate(arrays['end'])
+            index.arrays[str(records['chrom'][lo])] = arrays
+        return index
+
+    def get_matches(self, chrom: str, start: int, end: int, distance_cutoff: float) -> Dict[str, np.ndarray]:
+        '''
+        columns of records overlapping (start - 1, end) with distance to the interval <= distance_cutoff
+        '''
+        arrays = self.arrays.get(chrom)
+        if arrays is None:
+            return self.empty
+        fetch_start = max(0, start - 1)
+        lo = np.searchsorted(arrays['max_end'], fetch_start, side='right')
+        if distance_cutoff < 1:
+            # distance <= cutoff bounds how far left a record can start
+            size = end - start
+            lo = max(lo, np.searchsorted(
+                arrays['start'], np.floor(start - size * distance_cutoff / (1 - distance_cutoff)) - 1, side='left'))
+        hi = np.searchsorted(arrays['start'], end, side='right')
+        starts = arrays['start'][lo:hi]
+        ends = arrays['end'][lo:hi]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            distances = 1 - (np.minimum(ends, end) - np.maximum(starts, start)) / \
+                (np.maximum(ends, end) - np.minimum(starts, start))
+        mask = (ends > fetch_start) & (distances <= distance_cutoff)
+        return {key: val[lo:hi][mask] for key, val in arrays.items()}
@@ -0,0 +1,105 @@
+'''
+import ledger, for resuming an import that died
+Import_ledger rows are of three kinds:
+run: an import run, named by its generation (see Patient_SV.import_generation), with stage
+    importing, carriers or done. A run that isn't done is resumed by the next one, with its generation.
+patient: a patient, named by Patient.name, with stage parsed, annotated or written and the
+    fingerprint of its VCFs. written is set in the same transaction as its Patient_SV rows.
+partition: a (chrom, sv_type) partition of N_carriers written in the run of its generation,
+    named chrom:sv_type.
+'''
+import datetime
+import hashlib
+import os
+import sqlalchemy as sa
+from typing import Dict, Set, Tuple
+from lib import models, utils
+
+# input files of a patient
+PATIENT_FILES = ('manta_path', 'canvas_path', 'svtools_path', 'pbsv_path')
+
+
+def get_fingerprint(input_patient: dict) -> str:
+    '''
+    of the fingerprints (see utils.file_fingerprint) of a patient's VCFs. Checksums of
+    multi-gigabyte joint VCFs would take as long as parsing them
+    '''
+    md5 = hashlib.md5()
+    for key in PATIENT_FILES:
+        fname = input_patient.get(key) or ''
+        fingerprint = utils.file_fingerprint(fname) if fname and os.path.isfile(fname) else ''
+        md5.update(f";{key}={fingerprint}".encode())
+    return md5.hexdigest()
+
+
+def _set(connection, kind: str, name: str, generation: int, stage: str, fingerprint: str = None, match_generation: bool = True):
+    table = models.Import_ledger.__table__
+    condition = (table.c.kind == kind) & (table.c.name == name)
+    if match_generation:
+        condition = condition & (table.c.generation == generation)
+    values = {'generation': generation, 'stage': stage, 'fingerprint': fingerprint, 'updated': datetime.datetime.now()}
+    if connection.execute(sa.update(table).where(condition).values(**values)).rowcount == 0:
+        connection.execute(sa.insert(table).values(kind=kind, name=name, **values))
+
+
+def start_run(connection, first_generation: int) -> Tuple[int, bool]:
+    '''
+    generation of this run, and whether it resumes a run that did not finish.
+    A new run takes first_generation, or the one after the last run
+    '''
+    table = models.Import_ledger.__table__
+    last = connection.execute(
+        sa.select(table.c.generation, table.c.stage)
+        .where(table.c.kind == 'run')
+        .order_by(table.c.generation.desc())
+        .limit(1)
+    ).first()
+    if last is not None and last.stage != 'done':
+        return last.generation, True
+    generation = max(first_generation, last.generation + 1 if last is not None else 0)
+    set_run_stage(connection, generation, 'importing')
+    return generation, False
+
+
+def set_run_stage(connection, generation: int, stage: str):
+    _set(connection, 'run', str(generation), generation, stage)
+
+
+def get_patients(connection) -> Dict[str, Tuple[str, str]]:
+    '''
+    stage and fingerprint of patients, by name
+    '''
+    table = models.Import_ledger.__table__
+    rows = connection.execute(
+        sa.select(table.c.name, table.c.stage, table.c.fingerprint).where(table.c.kind == 'patient')
+    )
+    return {name: (stage, fingerprint) for name, stage, fingerprint in rows}
+
+
+def set_patient_stage(connection, name: str, generation: int, stage: str, fingerprint: str):
+    _set(connection, 'patient', name, generation, stage, fingerprint, match_generation=False)
+
+
+def get_partitions(connection, generation: int) -> Set[Tuple[str, str]]:
+    '''
+    N_carriers partitions written in the run of generation
+    '''
+    table = models.Import_ledger.__table__
+    rows = connection.execute(
+        sa.select(table.c.name).where((table.c.kind == 'partition') & (table.c.generation == generation))
+    )
+    return {tuple(name.split(':', 1)) for name, in rows}
+
+
+def set_partition_done(connection, generation: int, partition: Tuple[str, str]):
+    _set(connection, 'partition', ':'.join(partition), generation, 'written')
+
+
+def clear_partitions(connection, generation: int):
+    '''
+    N_carriers has to be redone, as patients were written since
+    '''
+    table = models.Import_ledger.__table__
+    connection.execute(
+        sa.delete(table).where((table.c.kind == 'partition') & (table.c.generation == generation))
+    )
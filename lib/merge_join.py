@@ -0,0 +1,56 @@
+'''
+sorted merge join of SVs against tabix files
+Instead of one tabix lookup per SV, a batch of SVs sorted by start walks a whole contig
+of the file once. Records are kept in an active window while they can still overlap
+a coming SV, so memory is bounded by the window rather than by the file.
+The records found for each SV are served through a Swept_reader, which stands in for
+the reader of the file, so the per SV annotation code is the same as for lookups.
+'''
+from typing import Any, Iterable, Iterator, List, Tuple
+
+
+def overlaps(record_start: int, record_end: int, start: int, end: int) -> bool:
+    '''
+    whether a record overlaps (start, end) the way tabix fetch would return it
+    '''
+    # tabix treats empty records as 1bp long, and empty regions have no records
+    return end > start and record_start < end and max(record_end, record_start + 1) > start
+
+
+def sweep(queries: Iterable[Tuple[int, int, Any]], records: Iterable[Tuple[str, int, int, Any]]) -> Iterator[Tuple[Any, List]]:
+    '''
+    queries: (start, end, key), sorted by start
+    records: (bucket, tabix start (0-based), tabix end, record) as parse_line, sorted by start
+    yield key and the records overlapping (start, end) of each query
+    '''
+    records = iter(records)
+    pending = next(records, None)
+    active = []
+    for start, end, key in queries:
+        while pending is not None and pending[1] < end:
+            active.append(pending)
+            pending = next(records, None)
+        # queries come in order of start, so records ending before this one are done with
+        active = [record for record in active if max(record[2], record[1] + 1) > start]
+        yield key, [record for record in active if overlaps(record[1], record[2], start, end)]
+
+
+class Swept_reader(object):
+    '''
+    answers fetch from the records swept for one query, filtered to the region asked
+    '''
+    def __init__(self, records: List[Tuple[str, int, int, Any]]):
+        self.records = records
+
+    def fetch(self, chrom: str, start: int, end: int, bucket: str = None) -> List[Any]:
+        return [
+            record for record_bucket, record_start, record_end, record in self.records
+            if (bucket is None or record_bucket == bucket) and overlaps(record_start, record_end, start, end)
+        ]
+
+
+def stream(reader, chrom: str, queries: Iterable[Tuple[int, int, Any]]) -> Iterator[Swept_reader]:
+    '''
+    walk chrom of a Tabix_reader once, yielding a Swept_reader for each query
+    '''
+    return (Swept_reader(records) for _, records in sweep(queries, reader.iter_contig(chrom)))
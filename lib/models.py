@@ -52,6 +52,8 @@ class Patient_SV(Base):
     source = sa.Column(sa.String, nullable=False)
     filter = sa.Column(sa.String, index=True)
     is_duplicate = sa.Column(sa.Boolean)
+    # which import run added the row. Used for incremental N_carriers
+    import_generation = sa.Column(sa.Integer, index=True)
     igv_real = sa.Column(sa.Boolean, index=True)
     validated_as_real = sa.Column(sa.Boolean, index=True)
     
@@ -89,6 +91,30 @@ class SV_CDS(Base):
     sv_id = sa.Column(sa.Integer, sa.ForeignKey("SV.id"), nullable=False)
     gene_id = sa.Column(sa.Integer, sa.ForeignKey("Gene.id"), nullable=False)
 
+class SV_Cluster(Base):
+    __tablename__ = 'SV_Cluster'
+
+    # SVs of a type clustered cohort wide, see lib/clusters.py
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    chrom = sa.Column(sa.String, index=True)
+    sv_type = sa.Column(sa.String, index=True)
+    core_start = sa.Column(sa.Integer, index=True)
+    core_end = sa.Column(sa.Integer, index=True)
+    mean_start = sa.Column(sa.Integer)
+    mean_end = sa.Column(sa.Integer)
+    loose_start = sa.Column(sa.Integer)
+    loose_end = sa.Column(sa.Integer)
+    N_SVs = sa.Column(sa.Integer)
+    # unique families carrying any SV of the cluster
+    N_carriers = sa.Column(sa.Integer, index=True)
+
+class SV_SV_Cluster(Base):
+    __tablename__ = 'SV_SV_Cluster'
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    sv_id = sa.Column(sa.Integer, sa.ForeignKey("SV.id"), nullable=False, index=True)
+    cluster_id = sa.Column(sa.Integer, sa.ForeignKey("SV_Cluster.id"), nullable=False, index=True)
+
 class HPO(Base):
     __tablename__ = 'HPO'
     
@@ -119,3 +145,154 @@ class Patient_HPO(Base):
     hpo_id = sa.Column(sa.Integer, sa.ForeignKey("HPO.id"), nullable=True)
     patient_id = sa.Column(sa.Integer, sa.ForeignKey("Patient.id"), nullable=False)
 
+
+class Annotation_cache(Base):
+    __tablename__ = 'Annotation_cache'
+    __table_args__ = (sa.UniqueConstraint('name', 'fingerprint'),)
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    # SV.name
+    name = sa.Column(sa.String, nullable=False)
+    # fingerprint of reference files, see annotation_cache.get_fingerprint
+    fingerprint = sa.Column(sa.String, nullable=False)
+    gnomad_freq = sa.Column(sa.Float)
+    dbvar_count = sa.Column(sa.Integer)
+    decipher_freq = sa.Column(sa.Float)
+    # comma separated ensembl gene ids
+    genes = sa.Column(sa.String, nullable=False)
+    cdss = sa.Column(sa.String, nullable=False)
+    exons = sa.Column(sa.String, nullable=False)
+
+class Bulk_load(Base):
+    __tablename__ = 'Bulk_load'
+
+    # a load in progress, with the non unique indexes of tables dropped, see lib/bulk_load.py
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    # comma separated table names
+    tables = sa.Column(sa.String, nullable=False)
+    started = sa.Column(sa.DateTime)
+
+class Import_ledger(Base):
+    __tablename__ = 'Import_ledger'
+    __table_args__ = (sa.UniqueConstraint('kind', 'name', 'generation'),)
+
+    # progress of imports: runs, patients and N_carriers partitions, see lib/ledger.py
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    kind = sa.Column(sa.String, nullable=False)
+    name = sa.Column(sa.String, nullable=False)
+    generation = sa.Column(sa.Integer, nullable=False)
+    stage = sa.Column(sa.String, nullable=False)
+    # of the VCFs of a patient
+    fingerprint = sa.Column(sa.String)
+    updated = sa.Column(sa.DateTime)
+
+'''
+R*Tree index on SV coordinates (sqlite only), kept in sync with SV by triggers.
+Each SV is a point (start, end) in its (chrom, sv_type) partition, so reciprocal overlap
+bounds become a box query. See lib.spatial for the search.
+'''
+SV_RTREE_DDL = [
+    '''CREATE TABLE IF NOT EXISTS SV_rtree_partition (
+        id INTEGER PRIMARY KEY,
+        chrom VARCHAR NOT NULL,
+        sv_type VARCHAR NOT NULL,
+        UNIQUE (chrom, sv_type)
+    )''',
+    '''CREATE VIRTUAL TABLE IF NOT EXISTS SV_rtree USING rtree_i32(
+        id, min_partition, max_partition, min_start, max_start, min_end, max_end
+    )''',
+    '''CREATE TRIGGER IF NOT EXISTS SV_rtree_insert AFTER INSERT ON SV
+    WHEN NEW.chrom IS NOT NULL AND NEW.sv_type IS NOT NULL AND NEW.start IS NOT NULL AND NEW."end" IS NOT NULL
+    BEGIN
+        INSERT OR IGNORE INTO SV_rtree_partition (chrom, sv_type) VALUES (NEW.chrom, NEW.sv_type);
+        INSERT INTO SV_rtree
+        SELECT NEW.id, id, id, NEW.start, NEW.start, NEW."end", NEW."end"
+        FROM SV_rtree_partition WHERE chrom = NEW.chrom AND sv_type = NEW.sv_type;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS SV_rtree_update AFTER UPDATE OF id, chrom, sv_type, start, "end" ON SV
+    BEGIN
+        DELETE FROM SV_rtree WHERE id = OLD.id;
+        INSERT OR IGNORE INTO SV_rtree_partition (chrom, sv_type)
+        SELECT NEW.chrom, NEW.sv_type WHERE NEW.chrom IS NOT NULL AND NEW.sv_type IS NOT NULL;
+        INSERT INTO SV_rtree
+        SELECT NEW.id, id, id, NEW.start, NEW.start, NEW."end", NEW."end"
+        FROM SV_rtree_partition WHERE chrom = NEW.chrom AND sv_type = NEW.sv_type
+        AND NEW.start IS NOT NULL AND NEW."end" IS NOT NULL;
+    END''',
+    '''CREATE TRIGGER IF NOT EXISTS SV_rtree_delete AFTER DELETE ON SV
+    BEGIN
+        DELETE FROM SV_rtree WHERE id = OLD.id;
+    END''',
+]
+
+
+def create_sv_rtree(connection):
+    '''
+    Create the R*Tree and its triggers if missing, and (re)fill it if it is out of sync with SV,
+    e.g. for databases created before the index existed.
+    '''
+    if connection.dialect.name != 'sqlite':
+        return
+    for ddl in SV_RTREE_DDL:
+        connection.exec_driver_sql(ddl)
+    n_rtree = connection.exec_driver_sql('SELECT COUNT(*) FROM SV_rtree').scalar()
+    n_sv = connection.exec_driver_sql(
+        'SELECT COUNT(*) FROM SV WHERE chrom IS NOT NULL AND sv_type IS NOT NULL '
+        'AND start IS NOT NULL AND "end" IS NOT NULL'
+    ).scalar()
+    if n_rtree == n_sv:
+        return
+    connection.exec_driver_sql('DELETE FROM SV_rtree')
+    connection.exec_driver_sql(
+        'INSERT OR IGNORE INTO SV_rtree_partition (chrom, sv_type) '
+        'SELECT DISTINCT chrom, sv_type FROM SV WHERE chrom IS NOT NULL AND sv_type IS NOT NULL'
+    )
+    connection.exec_driver_sql(
+        'INSERT INTO SV_rtree '
+        'SELECT SV.id, p.id, p.id, SV.start, SV.start, SV."end", SV."end" '
+        'FROM SV JOIN SV_rtree_partition p ON SV.chrom = p.chrom AND SV.sv_type = p.sv_type '
+        'WHERE SV.start IS NOT NULL AND SV."end" IS NOT NULL'
+    )
+
+
+# columns added to tables of earlier releases. create_all doesn't alter existing tables, see add_missing_columns
+ADDED_COLUMNS = [
+    (Patient_SV.__table__, 'import_generation'),
+]
+
+
+def get_column_names(connection, table: sa.Table) -> set:
+    if connection.dialect.name == 'sqlite':
+        return {row[1] for row in connection.exec_driver_sql(f'PRAGMA table_info("{table.name}")')}
+    return {column['name'] for column in sa.inspect(connection).get_columns(table.name)}
+
+
+def add_missing_columns(connection):
+    '''
+    Add ADDED_COLUMNS (and their indexes) missing from databases created before them.
+    Does nothing if they are there already.
+    '''
+    for table, name in ADDED_COLUMNS:
+        if name in get_column_names(connection, table):
+            continue
+        column = table.c[name]
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN {name} {column_type}')
+        for index in table.indexes:
+            if name in index.columns:
+                index.create(connection, checkfirst=True)
+
+
+def _create_sv_rtree(target, connection, **kw):
+    create_sv_rtree(connection)
+
+
+def _drop_sv_rtree(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    connection.exec_driver_sql('DROP TABLE IF EXISTS SV_rtree')
+    connection.exec_driver_sql('DROP TABLE IF EXISTS SV_rtree_partition')
+
+
+sa.event.listen(Base.metadata, 'after_create', _create_sv_rtree)
+sa.event.listen(Base.metadata, 'before_drop', _drop_sv_rtree)
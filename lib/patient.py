@@ -1,13 +1,28 @@
 import attr
 from pathlib import Path
 import os
-from collections import Counter
+from collections import Counter, deque
+from concurrent.futures import Future, ProcessPoolExecutor
 import numpy as np
 from cyvcf2 import VCF
-from typing import Type, Tuple, List
+from typing import Type, Tuple, List, Dict, Iterable, Iterator, Callable
 from lib import Params, Types, Interval_base
 
+# callers, in the order their SVs are imported
+CALLERS = ('manta', 'canvas', 'svtools', 'pbsv')
+# variants decoded at once by Patient.parse_records
+PARSE_CHUNK_SIZE = 10000
+# codes of SV types and genotypes to import
+IMPORTED_SVTYPES = {Types.SVTYPES.index(svtype) for svtype in (Types.SVtype.LOSS, Types.SVtype.GAIN, Types.SVtype.INV)}
+IMPORTED_GENOTYPES = {Types.GENOTYPES.index(genotype) for genotype in (Types.Genotype.HOM, Types.Genotype.HET)}
+
 class SV(Interval_base):
+    # annotations (see lib/annotation.py) and the db id are set later
+    __slots__ = (
+        'svtype', 'FILTER', 'source', 'vcf_id', 'genotype',
+        'gnomad_freq', 'dbvar_count', 'decipher_freq', 'genes', 'cdss', 'exons', 'id',
+    )
+
     def __init__(self, chrom, start, end, svtype, FILTER, source, vcf_id, genotype):
         super().__init__(chrom, start, end)
         self.name = f"{chrom}-{start}-{end}-{svtype.value}"
@@ -17,6 +32,11 @@ class SV(Interval_base):
         self.vcf_id: str = vcf_id
         self.genotype: Types.Genotype = genotype
 
+    @property
+    def svtype_code(self) -> int:
+        # index in Types.SVTYPES
+        return Types.SVTYPES.index(self.svtype)
+
 @attr.s(frozen=True)
 class Patient:
     """
@@ -34,45 +54,67 @@ class Patient:
         svs.extend(self.parse_vcf('canvas'))
         return svs
     
-    def parse_vcf(self, what:str) -> List[SV]:
+    def get_vcf_file(self, what:str):
         """
-        Parse Manta/Canvas file
-        
-        TODO: raise warning if finding no INV from manta
+        VCF file of a caller, None if the patient doesn't have it
         """
-        vcf = []
         what = what.lower()
         if what == 'manta':
-            if self.manta_file is None or not os.path.isfile(self.manta_file):
-                return []
-            vcf = VCF(self.manta_file)
+            fname = self.manta_file
         elif what == 'canvas':
-            if self.canvas_file is None or not os.path.isfile(self.canvas_file):
-                return []
-            vcf = VCF(self.canvas_file)
+            fname = self.canvas_file
         elif what == 'svtools':
-            if self.svtools_file is None or not os.path.isfile(self.svtools_file):
-                return []
-            vcf =  VCF(self.svtools_file)
+            fname = self.svtools_file
         elif what == 'pbsv':
-            if self.pbsv_file is None or not os.path.isfile(self.pbsv_file):
-                return []
-            vcf =  VCF(self.pbsv_file)
+            fname = self.pbsv_file
         else:
             raise ValueError(f"can only parse manta, canvas, svtools, pbsv file. Given {what}")
+        if fname is None or not os.path.isfile(fname):
+            return None
+        return fname
+
+    def get_vcf(self, what:str):
+        """
+        VCF of a caller, None if the patient doesn't have the file
+        """
+        fname = self.get_vcf_file(what)
+        if fname is None:
+            return None
+        return VCF(fname)
+
+    def parse_vcf(self, what:str, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> List[SV]:
+        """
+        Parse Manta/Canvas file, see iter_SVs
+        
+        TODO: raise warning if finding no INV from manta
+        """
+        return list(self.iter_SVs(what, contigs, keep_filter, keep_svtype))
+
+    def iter_SVs(self, what:str, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> Iterator[SV]:
+        """
+        SVs of a caller, only on contigs if given (see iter_variants).
+        keep_filter: predicate on FILTER (None for PASS), keep_svtype: predicate on Types.SVtype
+        """
+        vcf = self.get_vcf(what)
+        if vcf is None:
+            return
+        what = what.lower()
         sample_ind = vcf.samples.index(self.name)
-        svs = []
-        for variants in vcf:
+        for variants in iter_variants(vcf, self.get_vcf_file(what), contigs):
             if not variants.ALT:
                 continue
+            if keep_filter is not None and not keep_filter(variants.FILTER):
+                continue
             for variant_ind, variant in enumerate(variants.ALT):
                 svtype = translate_svtype(variants, variant)
                 genotype = translate_genotype(tuple(variants.genotypes[sample_ind]))
                 if svtype not in (Types.SVtype.LOSS, Types.SVtype.GAIN, Types.SVtype.INV):
                     continue
+                if keep_svtype is not None and not keep_svtype(svtype):
+                    continue
                 if genotype not in (Types.Genotype.HOM, Types.Genotype.HET):
                     continue
-                svs.append(SV(
+                yield SV(
                     variants.CHROM, 
                     int(variants.POS), 
                     int(variants.INFO.get('END')), 
@@ -81,8 +123,356 @@ class Patient:
                     what,
                     variants.ID,
                     genotype
-                    ))
-        return svs
+                    )
+
+    def parse_records(self, what:str, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> np.ndarray:
+        """
+        As parse_vcf, as an SV record array (see make_records), see iter_records
+        """
+        chunks = list(self.iter_records(what, contigs, keep_filter, keep_svtype))
+        if not chunks:
+            return make_records([])
+        return concatenate_records(chunks)
+
+    def iter_records(self, what:str, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> Iterator[np.ndarray]:
+        """
+        As iter_SVs, as SV record arrays of up to PARSE_CHUNK_SIZE variants, on contigs
+        of Types.CHROMOSOMES only (all of them if contigs is None). See iter_vcf_records
+        """
+        vcf = self.get_vcf(what)
+        if vcf is None:
+            return
+        sample_ind = vcf.samples.index(self.name)
+        for records in iter_vcf_records(vcf, self.get_vcf_file(what), what, [sample_ind], contigs, keep_filter, keep_svtype):
+            yield records[0]
+
+    def parse_all(self, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None, cohort=None) -> np.ndarray:
+        """
+        records of all callers. VCFs shared with other patients are taken from cohort if given
+        """
+        records = []
+        for what in CALLERS:
+            key = None if cohort is None else cohort.get_key(self, what)
+            if key is None:
+                records.append(self.parse_records(what, contigs, keep_filter, keep_svtype))
+            else:
+                cohort.parse(key)
+                records.append(cohort.take(self, key))
+        return concatenate_records(records)
+
+
+def iter_vcf_records(vcf: VCF, fname: str, what: str, sample_inds: List[int], contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> Iterator[List[np.ndarray]]:
+    """
+    SV records of samples (by index in vcf.samples), for up to PARSE_CHUNK_SIZE variants at a time:
+    a record array per sample. Only on contigs of Types.CHROMOSOMES (all of them if contigs is None).
+    Variants are decoded in chunks: svtypes through an Svtype_table, and genotypes of all samples
+    of a chunk at once (decode_genotypes), so dropped variants never become rows.
+    """
+    what = what.lower()
+    if contigs is None:
+        contigs = Types.CHROMOSOMES
+    contigs = [contig for contig in contigs if contig in Types.CHROMOSOME_CODES]
+    svtype_codes = IMPORTED_SVTYPES
+    if keep_svtype is not None:
+        svtype_codes = {code for code in IMPORTED_SVTYPES if keep_svtype(Types.SVTYPES[code])}
+    svtypes = Svtype_table()
+    # variants of the chunk, svtype codes of their ALTs, and genotype arrays of the samples
+    chunk = []
+    for variants in iter_variants(vcf, fname, contigs):
+        ALT = variants.ALT
+        if not ALT:
+            continue
+        if keep_filter is not None and not keep_filter(variants.FILTER):
+            continue
+        variant_codes = [code for code in (svtypes.get_code(variants, variant) for variant in ALT) if code in svtype_codes]
+        if not variant_codes:
+            continue
+        chunk.append((variants, variant_codes, variants.genotype.array()[sample_inds]))
+        if len(chunk) == PARSE_CHUNK_SIZE:
+            yield decode_chunk(chunk, what, len(sample_inds))
+            chunk = []
+    if chunk:
+        yield decode_chunk(chunk, what, len(sample_inds))
+
+
+def decode_chunk(chunk: List[Tuple], what: str, n_samples: int) -> List[np.ndarray]:
+    """
+    record arrays of each sample, of chunk of (variants, svtype codes, genotype arrays of the samples)
+    """
+    genotype_codes = decode_genotypes([genotypes for _, _, genotypes in chunk])
+    kept = np.isin(genotype_codes, list(IMPORTED_GENOTYPES))
+    # one row per ALT
+    variant_inds = np.array([ind for ind, (_, codes, _) in enumerate(chunk) for _ in codes], dtype=np.int64)
+    svtype_codes = np.array([code for _, codes, _ in chunk for code in codes], dtype=np.int8)
+    # columns of variants kept by any sample
+    chroms = np.zeros(len(chunk), dtype=np.int8)
+    starts = np.zeros(len(chunk), dtype=np.int64)
+    ends = np.zeros(len(chunk), dtype=np.int64)
+    filters = [''] * len(chunk)
+    vcf_ids = [''] * len(chunk)
+    for ind in np.flatnonzero(kept.any(axis=1)).tolist():
+        variants = chunk[ind][0]
+        chroms[ind] = Types.CHROMOSOME_CODES[variants.CHROM]
+        starts[ind] = variants.POS
+        ends[ind] = int(variants.INFO.get('END'))
+        filters[ind] = variants.FILTER or ''
+        vcf_ids[ind] = variants.ID or ''
+    filters = np.array(filters, dtype=str)
+    vcf_ids = np.array(vcf_ids, dtype=str)
+    result = []
+    for sample in range(n_samples):
+        sample_kept = kept[variant_inds, sample]
+        inds = variant_inds[sample_kept]
+        records = np.empty(len(inds), dtype=get_record_dtype(filters.itemsize // 4 or 1, len(what), vcf_ids.itemsize // 4 or 1))
+        records['chrom'] = chroms[inds]
+        records['start'] = starts[inds]
+        records['end'] = ends[inds]
+        records['svtype'] = svtype_codes[sample_kept]
+        records['genotype'] = genotype_codes[inds, sample]
+        records['filter'] = filters[inds]
+        records['source'] = what
+        records['vcf_id'] = vcf_ids[inds]
+        result.append(records)
+    return result
+
+
+def parse_cohort(what: str, fname: str, samples: List[str], contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None) -> Dict[str, np.ndarray]:
+    """
+    records of each of samples in a joint called VCF, in one pass over the file
+    """
+    vcf = VCF(fname)
+    sample_inds = [vcf.samples.index(sample) for sample in samples]
+    chunks = list(iter_vcf_records(vcf, fname, what, sample_inds, contigs, keep_filter, keep_svtype))
+    result = {}
+    for ind, sample in enumerate(samples):
+        if chunks:
+            result[sample] = concatenate_records([records[ind] for records in chunks])
+        else:
+            result[sample] = make_records([])
+    return result
+
+
+class Cohort(object):
+    """
+    VCFs shared by patients (joint called svtools/pbsv etc.), keyed by (caller, file).
+    Each is parsed once for all its patients (see parse_cohort), when the first of them
+    asks for it, and its records are dropped once the last one has taken them.
+    contigs, keep_filter and keep_svtype are as for Patient.parse_records
+    """
+    def __init__(self, patients: Iterable[Patient], contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None):
+        self.options = (contigs if contigs is None else list(contigs), keep_filter, keep_svtype)
+        samples = {}
+        for patient in patients:
+            for what in CALLERS:
+                fname = patient.get_vcf_file(what)
+                if fname is not None:
+                    samples.setdefault((what, fname), []).append(patient.name)
+        # patients yet to take their records
+        self.waiting = {key: names for key, names in samples.items() if len(set(names)) > 1}
+        # records by sample, or their future
+        self.parsed = {}
+
+    def get_key(self, patient: Patient, what: str):
+        key = (what, patient.get_vcf_file(what))
+        if key in self.waiting and patient.name in self.waiting[key]:
+            return key
+        return None
+
+    def parse(self, key: Tuple[str, str], executor: ProcessPoolExecutor = None):
+        """
+        parse the VCF of key unless it is already, in executor if given
+        """
+        if key in self.parsed:
+            return
+        what, fname = key
+        args = (what, fname, sorted(set(self.waiting[key])), *self.options)
+        if executor is None:
+            self.parsed[key] = parse_cohort(*args)
+        else:
+            self.parsed[key] = executor.submit(parse_cohort, *args)
+
+    def take(self, patient: Patient, key: Tuple[str, str]) -> np.ndarray:
+        parsed = self.parsed[key]
+        if isinstance(parsed, Future):
+            parsed = parsed.result()
+        records = parsed[patient.name]
+        self.waiting[key].remove(patient.name)
+        if not self.waiting[key]:
+            del self.waiting[key]
+            del self.parsed[key]
+        return records
+
+
+def iter_variants(vcf: VCF, fname: str, contigs: Iterable[str] = None) -> Iterator:
+    """
+    variants of vcf, only those on contigs if given.
+    With a tabix/csi index, contigs are read through region queries, in the order of the
+    header (or index) so variants come as in a full scan. Otherwise the whole file is scanned.
+    """
+    if contigs is None:
+        yield from vcf
+        return
+    contigs = set(contigs)
+    if os.path.isfile(fname + '.tbi') or os.path.isfile(fname + '.csi'):
+        for contig in vcf.seqnames:
+            if contig in contigs:
+                yield from vcf(contig)
+        return
+    for variants in vcf:
+        if variants.CHROM in contigs:
+            yield variants
+
+
+class Filter_set(object):
+    """
+    keep_filter predicate: whether all values of FILTER are in filters, where PASS also
+    matches None (cyvcf2 gives None for PASS). Picklable, unlike a lambda, for Parse_pool
+    """
+    def __init__(self, filters: Iterable[str]):
+        self.filters = set(filters)
+
+    def __call__(self, FILTER) -> bool:
+        if FILTER is None:
+            FILTER = 'PASS'
+        return all(value in self.filters for value in FILTER.split(';'))
+
+
+class Svtype_table(object):
+    """
+    translate_svtype codes (index in Types.SVTYPES), memoized on what they depend on:
+    ALT for Canvas, the ID prefix for Manta, and INFO SVTYPE for other callers
+    """
+    def __init__(self):
+        self.codes = {}
+
+    def get_code(self, variants, variant) -> int:
+        ID = variants.ID
+        if ID.startswith('Canvas'):
+            key = ('Canvas', variant)
+        elif ID.startswith('Manta'):
+            key = ('Manta', ID.split(':')[0])
+        else:
+            key = (None, variants.INFO.get('SVTYPE', None))
+        code = self.codes.get(key)
+        if code is None:
+            code = self.codes[key] = Types.SVTYPES.index(translate_svtype(variants, variant))
+        return code
+
+
+def decode_genotypes(genotypes: List[np.ndarray]) -> np.ndarray:
+    """
+    Genotype codes (index in Types.GENOTYPES), variants x samples, of cyvcf2 genotype arrays
+    of variants (a row per sample: alleles, padded with -2, then phased), as translate_genotype
+    of variants.genotypes, which counts 1s and 0s of the first two of (alleles..., phased)
+    """
+    n_samples = genotypes[0].shape[0] if genotypes else 0
+    codes = np.full((len(genotypes), n_samples), Types.GENOTYPES.index(Types.Genotype.UNKNOWN), dtype=np.int8)
+    # group by ploidy, which can differ between variants
+    by_size = {}
+    for ind, genotype in enumerate(genotypes):
+        by_size.setdefault(genotype.shape[-1], []).append(ind)
+    for size, inds in by_size.items():
+        genotype = np.stack([genotypes[ind] for ind in inds])
+        first = genotype[..., 0]
+        if size > 2:
+            # haploid calls of mixed ploidy records are padded, so their 2nd value is phased
+            second = np.where(genotype[..., 1] == -2, genotype[..., -1], genotype[..., 1])
+        else:
+            # all haploid: cyvcf2 reads phased past the end of the calls, which isn't defined.
+            # Take it as unphased
+            second = np.zeros_like(first)
+        ones = (first == 1).astype(int) + (second == 1)
+        zeros = (first == 0).astype(int) + (second == 0)
+        group_codes = np.full(first.shape, Types.GENOTYPES.index(Types.Genotype.UNKNOWN), dtype=np.int8)
+        group_codes[zeros == 2] = Types.GENOTYPES.index(Types.Genotype.REF)
+        group_codes[ones == 1] = Types.GENOTYPES.index(Types.Genotype.HET)
+        group_codes[ones == 2] = Types.GENOTYPES.index(Types.Genotype.HOM)
+        codes[inds] = group_codes
+    return codes
+
+def get_record_dtype(filter_size=1, source_size=1, vcf_id_size=1) -> np.dtype:
+    return np.dtype([
+        ('chrom', 'i1'),
+        ('start', 'i8'),
+        ('end', 'i8'),
+        ('svtype', 'i1'),
+        ('genotype', 'i1'),
+        ('filter', f'U{filter_size}'),
+        ('source', f'U{source_size}'),
+        ('vcf_id', f'U{vcf_id_size}'),
+    ])
+
+def make_records(rows: List[Tuple]) -> np.ndarray:
+    """
+    SV records: chrom code (index in Types.CHROMOSOMES), start, end, svtype and genotype codes
+    (index in Types.SVTYPES / Types.GENOTYPES), filter, source, vcf_id.
+    Strings are as wide as the longest one. Empty filter / vcf_id stand for None.
+    """
+    sizes = [max([len(row[ind]) for row in rows], default=1) or 1 for ind in (5, 6, 7)]
+    return np.array(rows, dtype=get_record_dtype(*sizes))
+
+def concatenate_records(records: List[np.ndarray]) -> np.ndarray:
+    sizes = [max(r.dtype[field].itemsize // 4 for r in records) for field in ('filter', 'source', 'vcf_id')]
+    dtype = get_record_dtype(*sizes)
+    return np.concatenate([r.astype(dtype) for r in records])
+
+def records_to_SVs(records: np.ndarray) -> List[SV]:
+    svs = []
+    for chrom, start, end, svtype, genotype, FILTER, source, vcf_id in records.tolist():
+        svs.append(SV(
+            Types.CHROMOSOMES[chrom],
+            start,
+            end,
+            Types.SVTYPES[svtype],
+            FILTER or None,
+            source,
+            vcf_id or None,
+            Types.GENOTYPES[genotype],
+        ))
+    return svs
+
+def _parse_records(patient: Patient, what: str, options: Tuple) -> np.ndarray:
+    return patient.parse_records(what, *options)
+
+class Parse_pool(object):
+    """
+    parse the VCFs of patients in worker processes, one task per (patient, caller).
+    contigs, keep_filter and keep_svtype are as for Patient.parse_records
+    """
+    def __init__(self, workers: int, contigs: Iterable[str] = None, keep_filter: Callable = None, keep_svtype: Callable = None):
+        self.workers = workers
+        self.options = (contigs if contigs is None else list(contigs), keep_filter, keep_svtype)
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+
+    def map(self, patients: Iterable[Patient], cohort: Cohort = None) -> Iterator[np.ndarray]:
+        """
+        records of each patient (as Patient.parse_all), in order.
+        At most 2 * workers patients are parsed ahead, to bound memory.
+        VCFs of cohort are parsed in one task for all their patients
+        """
+        pending = deque()
+        for patient in patients:
+            tasks = []
+            for what in CALLERS:
+                key = None if cohort is None else cohort.get_key(patient, what)
+                if key is None:
+                    tasks.append(self.executor.submit(_parse_records, patient, what, self.options))
+                else:
+                    cohort.parse(key, self.executor)
+                    tasks.append(key)
+            pending.append((patient, tasks))
+            if len(pending) > 2 * self.workers:
+                yield self.get_records(*pending.popleft(), cohort)
+        while pending:
+            yield self.get_records(*pending.popleft(), cohort)
+
+    @staticmethod
+    def get_records(patient: Patient, tasks: List, cohort: Cohort) -> np.ndarray:
+        # tasks are futures, or keys of cohort
+        return concatenate_records([cohort.take(patient, task) if isinstance(task, tuple) else task.result() for task in tasks])
+
+    def close(self):
+        self.executor.shutdown()
     
 
 def translate_svtype(variants, variant) -> Types.SVtype:
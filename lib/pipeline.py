@@ -0,0 +1,118 @@
+'''
+staged pipeline
+Each stage runs in its own thread, and hands its results to the next stage through a queue
+of at most depth items, so a stage waits (back-pressure) when the next one falls behind.
+Results of the last stage are yielded in order to the calling thread, e.g. a single db writer.
+'''
+import queue
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+
+class _Done(object):
+    '''
+    end of items, or an exception raised by a stage
+    '''
+    def __init__(self, error: BaseException = None):
+        self.error = error
+
+
+class Stage_counter(object):
+    '''
+    throughput of a stage: number of items, their size (e.g. SVs) and the time spent on them
+    '''
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.size = 0
+        self.busy = 0.
+
+    def add(self, size: int, seconds: float):
+        self.items += 1
+        self.size += size
+        self.busy += seconds
+
+    def __str__(self):
+        rate = self.size / self.busy if self.busy else 0
+        return f"{self.name}: {self.items} items, {self.size} SVs in {self.busy:.1f}s ({rate:.0f} SVs/s)"
+
+
+class Pipeline(object):
+    def __init__(self, stages: List[Tuple[str, Callable]], depth: int = 2, size: Callable[[Any], int] = None):
+        '''
+        stages: (name, function) each taking the result of the previous stage
+        size: size of a result for the counters
+        '''
+        self.stages = stages
+        self.depth = depth
+        self.size = size or (lambda x: 0)
+        self.counters = [Stage_counter(name) for name, _ in stages]
+        self.stopped = threading.Event()
+
+    def put(self, out_queue: queue.Queue, item):
+        # give up when the pipeline is stopped, so the thread can exit
+        while not self.stopped.is_set():
+            try:
+                out_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+
+    def get(self, in_queue: queue.Queue):
+        while not self.stopped.is_set():
+            try:
+                return in_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return _Done()
+
+    def feed(self, items: Iterable, out_queue: queue.Queue):
+        try:
+            for item in items:
+                if self.stopped.is_set():
+                    return
+                self.put(out_queue, item)
+        except BaseException as e:
+            self.put(out_queue, _Done(e))
+            return
+        self.put(out_queue, _Done())
+
+    def work(self, func: Callable, counter: Stage_counter, in_queue: queue.Queue, out_queue: queue.Queue):
+        while True:
+            item = self.get(in_queue)
+            if isinstance(item, _Done):
+                self.put(out_queue, item)
+                return
+            try:
+                start = time.time()
+                result = func(item)
+                counter.add(self.size(result), time.time() - start)
+            except BaseException as e:
+                self.put(out_queue, _Done(e))
+                return
+            self.put(out_queue, result)
+
+    def run(self, items: Iterable) -> Iterator:
+        queues = [queue.Queue(maxsize=self.depth) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self.feed, args=(items, queues[0]), daemon=True)]
+        for ind, (_, func) in enumerate(self.stages):
+            threads.append(threading.Thread(
+                target=self.work,
+                args=(func, self.counters[ind], queues[ind], queues[ind + 1]),
+                daemon=True,
+            ))
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = queues[-1].get()
+                if isinstance(item, _Done):
+                    if item.error is not None:
+                        raise item.error
+                    break
+                yield item
+        finally:
+            self.stopped.set()
+            for thread in threads:
+                thread.join()
@@ -0,0 +1,51 @@
+'''
+region queries on SV coordinates through the SV_rtree index (see models.create_sv_rtree)
+'''
+import math
+from typing import List, Tuple
+
+
+def get_partition_id(connection, chrom: str, sv_type: str):
+    return connection.exec_driver_sql(
+        'SELECT id FROM SV_rtree_partition WHERE chrom = ? AND sv_type = ?',
+        (chrom, sv_type),
+    ).scalar()
+
+
+def search_reciprocal_overlap(connection, chrom: str, sv_type: str, start: int, end: int, threshold: float) -> List[Tuple[int, int, int]]:
+    '''
+    return (id, start, end) of SVs of sv_type on chrom with similarity
+    (shared size / merged size) >= threshold to the interval, i.e. distance <= 1 - threshold.
+    Similarity >= threshold bounds both start and end of a hit,
+    so candidates come from a box query on the R*Tree, with 1bp slack against rounding.
+    '''
+    if not 0 < threshold <= 1:
+        raise ValueError(f"threshold has to be in (0, 1], got {threshold}")
+    partition_id = get_partition_id(connection, chrom, sv_type)
+    if partition_id is None:
+        return []
+    size = end - start
+    extension = size * (1 / threshold - 1)
+    shrink = size * (1 - threshold)
+    candidates = connection.exec_driver_sql(
+        'SELECT id, min_start, min_end FROM SV_rtree '
+        'WHERE min_partition = ? AND min_start >= ? AND max_start <= ? '
+        'AND min_end >= ? AND max_end <= ?',
+        (
+            partition_id,
+            math.floor(start - extension) - 1,
+            math.ceil(start + shrink) + 1,
+            math.floor(end - shrink) - 1,
+            math.ceil(end + extension) + 1,
+        ),
+    )
+    result = []
+    for sv_id, sv_start, sv_end in candidates:
+        denominator = max(sv_end, end) - min(sv_start, start)
+        if denominator == 0:
+            similarity = 1
+        else:
+            similarity = (min(sv_end, end) - max(sv_start, start)) / denominator
+        if similarity >= threshold:
+            result.append((sv_id, sv_start, sv_end))
+    return result
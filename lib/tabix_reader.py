@@ -0,0 +1,74 @@
+'''
+shared tabix reader
+A region is fetched in fixed size windows. Each line of a window is parsed once into
+records bucketed by SV type, and the most recently used windows are kept,
+since neighbouring SVs hit the same windows.
+'''
+from collections import OrderedDict
+from typing import Any, Iterator, List, Tuple
+import pysam
+
+
+class Tabix_reader(object):
+    window_size = 100000
+    cache_size = 64
+
+    def __init__(self, fname, encoding='ascii'):
+        self.fname = fname
+        self.tbx = pysam.TabixFile(fname, encoding=encoding)
+        self.windows = OrderedDict()
+
+    def parse_line(self, line: str) -> List[Tuple[str, int, int, Any]]:
+        '''
+        return (bucket, tabix start (0-based), tabix end, record) for each record of the line
+        '''
+        raise NotImplementedError
+
+    def get_window(self, chrom: str, window_ind: int) -> List[Tuple[str, int, int, Any]]:
+        key = (chrom, window_ind)
+        if key in self.windows:
+            self.windows.move_to_end(key)
+            return self.windows[key]
+        records = []
+        try:
+            it = self.tbx.fetch(chrom, window_ind * self.window_size, (window_ind + 1) * self.window_size)
+        except ValueError:
+            it = []
+        for line in it:
+            records.extend(self.parse_line(line))
+        self.windows[key] = records
+        if len(self.windows) > self.cache_size:
+            self.windows.popitem(last=False)
+        return records
+
+    def fetch(self, chrom: str, start: int, end: int, bucket: str) -> List[Any]:
+        '''
+        records of the bucket that tbx.fetch(chrom, start, end) would return, in the same order
+        '''
+        result = []
+        if end <= start:
+            return result
+        for window_ind in range(start // self.window_size, (end - 1) // self.window_size + 1):
+            for record_bucket, record_start, record_end, record in self.get_window(chrom, window_ind):
+                if record_bucket != bucket:
+                    continue
+                # tabix treats empty records as 1bp long
+                record_end = max(record_end, record_start + 1)
+                if record_start >= end or record_end <= start:
+                    continue
+                # records spanning windows are taken from the window where they enter the region
+                if max(record_start, start) // self.window_size != window_ind:
+                    continue
+                result.append(record)
+        return result
+
+    def iter_contig(self, chrom: str) -> Iterator[Tuple[str, int, int, Any]]:
+        '''
+        parsed records of a whole contig in file order, without caching, see merge_join
+        '''
+        try:
+            it = self.tbx.fetch(chrom)
+        except ValueError:
+            return
+        for line in it:
+            yield from self.parse_line(line)
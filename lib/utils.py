@@ -1,7 +1,11 @@
 import gzip
+import hashlib
 import os
-from typing import List, Set
-from lib import Params, Types, Interval_base, Interval_base
+from typing import Dict, List, Set
+from lib import Types
+# from the modules, as lib.gnomad uses utils while lib is still being imported
+from lib.Types import Params
+from lib.interval import Interval_base
 
 
 def read_cnv_file(infile):
@@ -35,6 +39,21 @@ def read_cnv_file(infile):
                 result.append(row_dict)
     return result
 
+def file_fingerprint(fname) -> str:
+    '''
+    md5 of the path, size and modification time of the file.
+    Reference files are too large to read through on every run
+    '''
+    stat = os.stat(fname)
+    return hashlib.md5(f"{os.path.abspath(fname)}:{stat.st_size}:{stat.st_mtime_ns}".encode()).hexdigest()
+
+def parse_gtf_info(attributes: str) -> Dict[str, str]:
+    info = {}
+    for field in attributes.split('; '):
+        key, value = field.split(' ', 1)
+        info[key] = value.split('"')[1]
+    return info
+
 def _get_overlap(interval:Interval_base, sequence_type, tbx_gtf, gene_id:bool, protein_coding_gene:bool) -> Set[str]:
     result = set()
     chrom = interval.chrom.lstrip('chr')
@@ -44,10 +63,7 @@ def _get_overlap(interval:Interval_base, sequence_type, tbx_gtf, gene_id:bool, p
         row = line.rstrip().split('\t')
         if row[2] != sequence_type:
             continue
-        info = {}
-        for field in row[-1].split('; '):
-            key, value = field.split(' ', 1)
-            info[key] = value.split('"')[1]
+        info = parse_gtf_info(row[-1])
         if protein_coding_gene and info.get('transcript_biotype', info['gene_biotype']) != 'protein_coding':
             continue
         if gene_id:
@@ -2,7 +2,8 @@
 Prepare for action
 0. remove db
 1. Download HPO terms and HPO genes
-2. import HPO and genes
+2. import HPO and genes, caching the GTF index next to the db (with indexes built after, in bulk_load mode)
+3. compile gnomad sidecar
 '''
 import os
 import sys
@@ -11,13 +12,23 @@ import gzip
 import urllib.request
 from sqlalchemy import create_engine
 from sqlalchemy.orm import Session, declarative_base
-from lib import models
+from lib import models, gnomad, gtf, bulk_load
 
 def main(config):
     
     engine = create_engine(config['db'])
+    # sqlite PRAGMAs for loading, and non unique indexes dropped until all is loaded
+    if config.get('bulk_load', False):
+        bulk_load.set_pragmas(engine)
     models.Base.metadata.drop_all(engine)
     models.Base.metadata.create_all(engine)
+    if config.get('bulk_load', False):
+        bulk_load.drop_indexes(engine, [
+            models.HPO.__table__,
+            models.HPO_HPO.__table__,
+            models.Gene.__table__,
+            models.HPO_Gene.__table__,
+        ])
     
     # HPO
     with urllib.request.urlopen(config['hpo_obo_url']) as f:
@@ -90,43 +101,36 @@ def main(config):
             }
     # store genes[symbol] = id for HPO_gene,  which doesn't have ensembl id
     genes = {}
-    with gzip.open(config['gene_tbx'], 'rt') as inf:
-        entities = []
-        for line in inf:
-            if line.startswith('#'):
-                continue
-            row = line.rstrip().split('\t')
-            if row[2] != 'gene':
-                continue
-            info = {}
-            for info_field in row[-1].split('; '):
-                key, val = info_field.split(' ')
-                val = val.strip('"')
-                info[key] = val
-            
-            gene_id = int(info['gene_id'].lstrip('ENSG'))
+    # genes come from the GTF index, which is cached next to the db for import_SV
+    gtf_index = gtf.load(config)
+    entities = []
+    for (chrom, feature), arrays in gtf_index.arrays.items():
+        if feature != 'gene':
+            continue
+        for start, end, gene in zip(arrays['start'].tolist(), arrays['end'].tolist(), arrays['gene'].tolist()):
+            gene_id = gtf_index.gene_numbers[gene]
             # sometimes in GRCh38 there's no gene_name
-            symbol = info.get('gene_name', info['gene_id'])
+            symbol = gtf_index.gene_names[gene] or gtf_index.gene_ids[gene]
             genes[symbol] = gene_id
             constraints = gnomad_constraints.get(gene_id, {
                 'pli': None,
                 'prec': None,
                 'oe_lof_upper': None
             })
-            
+
             entities.append(models.Gene(
                 id = gene_id,
                 symbol = symbol,
-                chrom = row[0],
-                start = int(row[3]),
-                end = int(row[4]),
+                chrom = chrom,
+                start = start,
+                end = end,
                 pli = constraints['pli'],
                 prec = constraints['prec'],
                 oe_lof_upper =  constraints['oe_lof_upper'],
             ))
-        with Session(engine) as session:
-            session.add_all(entities)
-            session.commit()
+    with Session(engine) as session:
+        session.add_all(entities)
+        session.commit()
     # HPO_gene
     with urllib.request.urlopen(config['hpo_gene_url']) as f:
         entities = []
@@ -156,6 +160,13 @@ def main(config):
             session.add_all(entities)
             session.commit()
             
+    if config.get('bulk_load', False):
+        bulk_load.rebuild_indexes(engine)
+
+    # gnomad sidecar
+    if config.get('gnomad_sidecar'):
+        gnomad.Gnomad.compile_sidecar(config['gnomad'], config['gnomad_sidecar'])
+
 if __name__ == '__main__':
     with open('config.yml', 'rt') as inf:
         config = yaml.safe_load(inf)
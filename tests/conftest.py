@@ -0,0 +1,156 @@
+'''
+small reference files, VCFs and patients.tsv written to a tmp dir, for tests that run import_SV
+'''
+import os
+import random
+import sys
+import pysam
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+CHROMS = ['1', '2', 'X']
+POPS = ['AFR', 'AMR', 'EUR', 'OTH', 'EAS']
+
+
+def bgzip_tabix(path, lines, **kwargs):
+    with open(path, 'wt') as outf:
+        outf.write(''.join(line + '\n' for line in lines))
+    pysam.tabix_compress(path, path + '.gz', force=True)
+    pysam.tabix_index(path + '.gz', force=True, **kwargs)
+    return path + '.gz'
+
+
+def random_intervals(rng, n):
+    result = []
+    for _ in range(n):
+        start = rng.randint(1, 100000)
+        result.append((rng.choice(CHROMS), start, start + rng.choice([50, 500, 5000, rng.randint(1, 20000)])))
+    return sorted(result)
+
+
+def make_dbvar(path, rng):
+    lines = ['#chr\touter_start\touter_end\tsample_count\tsub_type\tmethod\tanalysis\tplatform\tstudy\tclinical_assertion\tclinvar_assertion\tbin_size']
+    for chrom, start, end in random_intervals(rng, 200):
+        lines.append('\t'.join(map(str, [chrom, start, end, rng.randint(1, 30), 'deletion', 'm', 'a', 'p', 'nstd1', '', '', 'small'])))
+    return bgzip_tabix(path, lines, seq_col=0, start_col=1, end_col=2, meta_char='#')
+
+
+def make_decipher(path, rng):
+    lines = ['#population_cnv_id\tchr\tstart\tend\tdeletion_observations\tdeletion_frequency\tdeletion_standard_error\tduplication_observations\tduplication_frequency\tduplication_standard_error\tobservations\tfrequency\tstandard_error\ttype\tsample_size\tstudy']
+    for i, (chrom, start, end) in enumerate(random_intervals(rng, 200)):
+        deletions, duplications, size = rng.randint(0, 5), rng.randint(0, 3), rng.randint(10, 500)
+        lines.append('\t'.join(map(str, [
+            i, chrom, start, end, deletions, deletions / size, 0.01, duplications, duplications / size, 0.02,
+            deletions + duplications, (deletions + duplications) / size, 0.03, rng.choice(['1', '0', '-1']), size, 'study',
+        ])))
+    return bgzip_tabix(path, lines, seq_col=1, start_col=2, end_col=3, meta_char='#')
+
+
+def make_gnomad(path, rng):
+    ac_fields = ['AC', 'MALE_AC', 'FEMALE_AC'] + [f'{pop}_{key}' for pop in POPS for key in ('AC', 'MALE_AC', 'FEMALE_AC')]
+    an_fields = [field.replace('AC', 'AN') for field in ac_fields]
+    af_fields = [field.replace('AC', 'AF') for field in ac_fields]
+    lines = ['##fileformat=VCFv4.2']
+    for field, number, field_type in [('END', '1', 'Integer'), ('SVTYPE', '1', 'String'), ('SVLEN', '1', 'Integer')]:
+        lines.append(f'##INFO=<ID={field},Number={number},Type={field_type},Description="-">')
+    lines += [f'##INFO=<ID={field},Number=A,Type=Integer,Description="-">' for field in ac_fields + af_fields]
+    lines += [f'##INFO=<ID={field},Number=1,Type=Integer,Description="-">' for field in an_fields]
+    lines.append('#CHROM\tPOS\tEND\tID\tREF\tALT\tQUAL\tFILTER\tINFO')
+    for i, (chrom, start, end) in enumerate(random_intervals(rng, 200)):
+        svtype = rng.choice(['DEL', 'DUP', 'INV'])
+        info = [f'END={end}', f'SVTYPE={svtype}', f'SVLEN={end - start}']
+        info += [f'{field}={rng.randint(1, 2000)}' for field in an_fields]
+        info += [f'{field}={rng.randint(0, 40)}' for field in ac_fields + af_fields]
+        lines.append('\t'.join(map(str, [chrom, start, end, f'gnomAD_{i}', 'N', f'<{svtype}>', '100', 'PASS', ';'.join(info)])))
+    return bgzip_tabix(path, lines, seq_col=0, start_col=1, end_col=2, meta_char='#')
+
+
+def make_gtf(path, rng):
+    rows = []
+    for n in range(50):
+        chrom = rng.choice(CHROMS)
+        start = rng.randint(1, 100000)
+        end = start + rng.randint(100, 20000)
+        attributes = f'gene_id "ENSG{n:011d}"; gene_name "G{n}"; gene_biotype "protein_coding";'
+        rows.append((chrom, start, end, 'gene', attributes))
+        for exon in range(rng.randint(1, 4)):
+            exon_start = rng.randint(start, end)
+            exon_end = min(end, exon_start + rng.randint(10, 500))
+            exon_attributes = attributes + f' transcript_id "ENST{n:011d}"; exon_number "{exon}"; transcript_biotype "protein_coding";'
+            rows.append((chrom, exon_start, exon_end, 'exon', exon_attributes))
+            rows.append((chrom, exon_start, exon_end, 'CDS', exon_attributes))
+    lines = [
+        '\t'.join(map(str, [chrom, 'ensembl', feature, start, end, '.', '+', '.', attributes]))
+        for chrom, start, end, feature, attributes in sorted(rows)
+    ]
+    return bgzip_tabix(path, lines, preset='gff')
+
+
+def make_vcf(path, sample, rng, caller):
+    lines = ['##fileformat=VCFv4.1']
+    lines += [f'##contig=<ID={chrom},length=200000>' for chrom in CHROMS]
+    lines += [
+        '##INFO=<ID=END,Number=1,Type=Integer,Description="-">',
+        '##INFO=<ID=SVTYPE,Number=1,Type=String,Description="-">',
+        '##FORMAT=<ID=GT,Number=1,Type=String,Description="-">',
+        f'#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{sample}',
+    ]
+    for i, (chrom, start, end) in enumerate(random_intervals(rng, 40)):
+        genotype = rng.choice(['0/1', '1/1'])
+        if caller == 'manta':
+            svtype = rng.choice(['DEL', 'DUP', 'INV'])
+            lines.append('\t'.join(map(str, [chrom, start, f'Manta{svtype}:{i}:0:1:0:0:0', 'N', f'<{svtype}>', '.', 'PASS', f'END={end};SVTYPE={svtype}', 'GT', genotype])))
+        else:
+            alt = rng.choice(['<CN0>', '<CN3>'])
+            kind = 'LOSS' if alt == '<CN0>' else 'GAIN'
+            lines.append('\t'.join(map(str, [chrom, start, f'Canvas:{kind}:{chrom}:{start}-{end}', 'N', alt, '.', 'PASS', f'END={end};SVTYPE=CNV', 'GT', genotype])))
+    return bgzip_tabix(path, lines, preset='vcf')
+
+
+def write_patients(path, patients):
+    keys = list(patients[0])
+    with open(path, 'wt') as outf:
+        outf.write('\t'.join(keys) + '\n')
+        for patient in patients:
+            outf.write('\t'.join(patient[key] for key in keys) + '\n')
+
+
+@pytest.fixture
+def import_config(tmp_path):
+    '''
+    config for import_SV, with patients.tsv of 4 patients and patients_a.tsv of the first 2
+    '''
+    rng = random.Random(0)
+    patients = []
+    for n in range(4):
+        name = f'P{n}'
+        patients.append({
+            'family_id': f'F{n // 2}',
+            'name': name,
+            'is_proband': str(int(n % 2 == 0)),
+            'relation_to_proband': '',
+            'disease': 'RD',
+            'HPO': 'HP:0000556' if n % 2 else '',
+            'bam_path': f'/bam/{name}.bam',
+            'manta_path': make_vcf(str(tmp_path / f'{name}.manta.vcf'), name, rng, 'manta'),
+            'canvas_path': make_vcf(str(tmp_path / f'{name}.canvas.vcf'), name, rng, 'canvas'),
+            'svtools_path': '',
+            'pbsv_path': '',
+            'is_solved': '0',
+        })
+    write_patients(tmp_path / 'patients.tsv', patients)
+    write_patients(tmp_path / 'patients_a.tsv', patients[:2])
+    return {
+        'patients': str(tmp_path / 'patients.tsv'),
+        'db': f"sqlite:///{tmp_path / 'svrare.sqlite'}",
+        'gene_tbx': make_gtf(str(tmp_path / 'genes.gtf'), rng),
+        'params': {'output_format': 'tsv', 'distance': 0.5, 'cutoffs': {}},
+        'dbvar': {
+            'LOSS': make_dbvar(str(tmp_path / 'dbvar_loss.tsv'), rng),
+            'GAIN': make_dbvar(str(tmp_path / 'dbvar_gain.tsv'), rng),
+        },
+        'decipher': make_decipher(str(tmp_path / 'decipher.txt'), rng),
+        'gnomad': make_gnomad(str(tmp_path / 'gnomad.vcf'), rng),
+        'import': {},
+    }
@@ -0,0 +1,13 @@
+'''
+fingerprint of the reference files of the annotation cache
+'''
+import random
+from lib import annotation_cache
+from conftest import make_gnomad
+
+
+def test_fingerprint_changes_with_reference_files(import_config, tmp_path):
+    fingerprint = annotation_cache.get_fingerprint(import_config)
+    assert annotation_cache.get_fingerprint(import_config) == fingerprint
+    make_gnomad(str(tmp_path / 'gnomad.vcf'), random.Random(1))
+    assert annotation_cache.get_fingerprint(import_config) != fingerprint
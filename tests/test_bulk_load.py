@@ -0,0 +1,43 @@
+'''
+bulk-load mode of import_SV
+'''
+import sqlalchemy as sa
+import import_SV
+from lib import bulk_load, models
+
+
+def get_indexes(engine):
+    with engine.connect() as connection:
+        return sorted(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+
+
+def test_new_load_takes_over_interrupted_one(import_config, monkeypatch):
+    config = dict(import_config, bulk_load=True, patients=import_config['patients'].replace('patients.tsv', 'patients_a.tsv'))
+    engine = sa.create_engine(config['db'])
+    import_SV.main(config)
+    indexes = get_indexes(engine)
+    # an interrupted load, of other tables too
+    bulk_load.drop_indexes(engine, [models.SV.__table__, models.Patient_SV.__table__, models.Gene.__table__])
+    assert len(get_indexes(engine)) < len(indexes)
+
+    rebuilds = []
+    rebuild_indexes = bulk_load.rebuild_indexes
+    def count_rebuilds(engine):
+        rebuilds.append(get_indexes(engine))
+        rebuild_indexes(engine)
+    monkeypatch.setattr(bulk_load, 'rebuild_indexes', count_rebuilds)
+    import_SV.main(dict(config, patients=import_config['patients']))
+    # indexes are rebuilt once, after the load
+    assert len(rebuilds) == 1
+    assert get_indexes(engine) == indexes
+    with engine.connect() as connection:
+        assert connection.execute(sa.select(sa.func.count()).select_from(models.Bulk_load)).scalar() == 0
+
+
+def test_repair_without_bulk_load(import_config):
+    engine = sa.create_engine(import_config['db'])
+    import_SV.main(import_config)
+    indexes = get_indexes(engine)
+    bulk_load.drop_indexes(engine, [models.SV.__table__, models.Patient_SV.__table__])
+    import_SV.main(import_config)
+    assert get_indexes(engine) == indexes
@@ -0,0 +1,42 @@
+'''
+cohort wide SV clusters
+'''
+import random
+from collections import Counter
+import numpy as np
+import sqlalchemy as sa
+import import_SV
+from lib import clusters
+
+
+def test_one_cluster_per_SV():
+    rng = random.Random(0)
+    coords = []
+    for _ in range(300):
+        start = rng.randint(1, 50000)
+        coords.append((start, start + rng.choice([100, 500, 2000, rng.randint(10, 10000)])))
+    coords.sort()
+    ids = np.arange(1, len(coords) + 1)
+    starts = np.array([start for start, _ in coords])
+    ends = np.array([end for _, end in coords])
+    result = clusters.get_clusters('1', ids, starts, ends, 0.5)
+    counts = Counter(interval.sv_id for cluster in result for interval in cluster.intervals)
+    assert sorted(counts) == ids.tolist()
+    assert set(counts.values()) == {1}
+    # SVs of a cluster overlap its core
+    for cluster in result:
+        assert cluster.core_start <= cluster.core_end
+        assert all(interval.start <= cluster.core_end and interval.end >= cluster.core_start for interval in cluster.intervals)
+    # deterministic
+    again = clusters.get_clusters('1', ids, starts, ends, 0.5)
+    assert [[i.sv_id for i in c.intervals] for c in again] == [[i.sv_id for i in c.intervals] for c in result]
+
+def test_import_clusters(import_config):
+    import_SV.main(dict(import_config, **{'import': {'sv_clusters': True}}))
+    engine = sa.create_engine(import_config['db'])
+    with engine.connect() as connection:
+        n_SVs = connection.execute(sa.text('SELECT COUNT(*) FROM SV')).scalar()
+        rows = connection.execute(sa.text('SELECT COUNT(*), COUNT(DISTINCT sv_id) FROM SV_SV_Cluster')).one()
+        total = connection.execute(sa.text('SELECT SUM(N_SVs) FROM SV_Cluster')).scalar()
+    assert tuple(rows) == (n_SVs, n_SVs)
+    assert total == n_SVs
@@ -0,0 +1,35 @@
+'''
+gnomad sidecar, rebuilt when the gnomad file changes
+'''
+import os
+import random
+import numpy as np
+from lib import gnomad
+from conftest import make_gnomad
+
+
+def test_sidecar_rebuilt_when_gnomad_changes(tmp_path):
+    fname = make_gnomad(str(tmp_path / 'gnomad.vcf'), random.Random(0))
+    sidecar = str(tmp_path / 'gnomad.sidecar.npy')
+    assert not gnomad.is_sidecar_current(fname, sidecar)
+    gnomad.load_sidecar.cache_clear()
+    gnomad.load_sidecar(fname, sidecar)
+    assert gnomad.is_sidecar_current(fname, sidecar)
+    old_records = np.load(sidecar)
+
+    # same path, other records
+    make_gnomad(str(tmp_path / 'gnomad.vcf'), random.Random(1))
+    assert not gnomad.is_sidecar_current(fname, sidecar)
+    gnomad.load_sidecar.cache_clear()
+    gnomad.load_sidecar(fname, sidecar)
+    assert gnomad.is_sidecar_current(fname, sidecar)
+    new_records = np.load(sidecar)
+    # recompiled from the new records
+    assert not np.array_equal(new_records, old_records)
+    expected = str(tmp_path / 'expected.npy')
+    gnomad.Gnomad.compile_sidecar(fname, expected)
+    assert np.array_equal(new_records, np.load(expected))
+    assert sorted(os.listdir(tmp_path)) == sorted([
+        'gnomad.vcf', 'gnomad.vcf.gz', 'gnomad.vcf.gz.tbi',
+        'gnomad.sidecar.npy', 'gnomad.sidecar.npy.json', 'expected.npy', 'expected.npy.json',
+    ])
@@ -0,0 +1,48 @@
+'''
+GTF index cache, rebuilt when the GTF file changes
+'''
+import os
+import random
+import numpy as np
+import pytest
+from lib import gtf
+from conftest import make_gtf
+
+
+def get_genes(index):
+    return index.get_overlaps(['1', '2', 'X'], [0, 0, 0], [200000, 200000, 200000], 'gene')
+
+
+def test_cache_rebuilt_when_gtf_changes(tmp_path):
+    fname = make_gtf(str(tmp_path / 'genes.gtf'), random.Random(0))
+    cache_dir = str(tmp_path / 'gtf_cache')
+    genes = get_genes(gtf.Gtf_index.cached(fname, cache_dir))
+    assert get_genes(gtf.Gtf_index.from_file(fname)) == genes
+    assert get_genes(gtf.Gtf_index.cached(fname, cache_dir)) == genes
+
+    make_gtf(str(tmp_path / 'genes.gtf'), random.Random(1))
+    new_genes = get_genes(gtf.Gtf_index.cached(fname, cache_dir))
+    assert new_genes != genes
+    assert new_genes == get_genes(gtf.Gtf_index.from_file(fname))
+    assert sorted(os.listdir(tmp_path)) == ['genes.gtf', 'genes.gtf.gz', 'genes.gtf.gz.tbi', 'gtf_cache']
+
+
+def test_interrupted_save_keeps_cache(tmp_path, monkeypatch):
+    fname = make_gtf(str(tmp_path / 'genes.gtf'), random.Random(0))
+    cache_dir = str(tmp_path / 'gtf_cache')
+    genes = get_genes(gtf.Gtf_index.cached(fname, cache_dir))
+    # of other genes, to tell a mix of the two caches
+    index = gtf.Gtf_index.from_file(make_gtf(str(tmp_path / 'other.gtf'), random.Random(1)))
+    save = np.save
+    def interrupted(file, *args, **kwargs):
+        if str(file).endswith('gene.npy'):
+            raise KeyboardInterrupt
+        save(file, *args, **kwargs)
+    monkeypatch.setattr(np, 'save', interrupted)
+    with pytest.raises(KeyboardInterrupt):
+        index.save(cache_dir, 'another fingerprint')
+    monkeypatch.setattr(np, 'save', save)
+    # the cache left is the one of the earlier save, in one piece
+    assert get_genes(gtf.Gtf_index.cached(fname, cache_dir)) == genes
+    with open(os.path.join(cache_dir, 'meta.json'), 'rt') as inf:
+        assert 'another fingerprint' not in inf.read()
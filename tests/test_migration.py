@@ -0,0 +1,122 @@
+'''
+import_SV on databases created before columns were added to their tables (see models.ADDED_COLUMNS)
+'''
+import sqlalchemy as sa
+import import_SV
+from lib import models
+
+
+def create_old_schema(engine):
+    '''
+    tables of prepare.py before models.ADDED_COLUMNS, without the tables added since
+    '''
+    added = {(table.name, name) for table, name in models.ADDED_COLUMNS}
+    old_tables = ['Patient', 'SV', 'Patient_SV', 'Gene', 'SV_Gene', 'SV_exon', 'SV_cds', 'HPO', 'HPO_HPO', 'HPO_Gene', 'Patient_HPO']
+    metadata = sa.MetaData()
+    for name in old_tables:
+        table = models.Base.metadata.tables[name]
+        sa.Table(name, metadata, *(column._copy() for column in table.columns if (name, column.name) not in added))
+    metadata.create_all(engine)
+
+
+def get_columns(engine, table_name):
+    with engine.connect() as connection:
+        return {column['name'] for column in sa.inspect(connection).get_columns(table_name)}
+
+
+def test_add_missing_columns(tmp_path):
+    engine = sa.create_engine(f"sqlite:///{tmp_path / 'old.sqlite'}")
+    create_old_schema(engine)
+    assert 'import_generation' not in get_columns(engine, 'Patient_SV')
+    for _ in range(2):
+        with engine.begin() as connection:
+            models.add_missing_columns(connection)
+    assert 'import_generation' in get_columns(engine, 'Patient_SV')
+    with engine.connect() as connection:
+        indexes = {index['name'] for index in sa.inspect(connection).get_indexes('Patient_SV')}
+    assert 'ix_Patient_SV_import_generation' in indexes
+
+
+def test_import_into_old_schema(import_config):
+    engine = sa.create_engine(import_config['db'])
+    create_old_schema(engine)
+    import_SV.main(import_config)
+    with engine.connect() as connection:
+        assert connection.execute(sa.text('SELECT COUNT(DISTINCT patient_id) FROM Patient_SV')).scalar() == 4
+        generations = connection.execute(sa.text('SELECT DISTINCT import_generation FROM Patient_SV')).scalars().all()
+    assert generations == [1]
+
+
+def make_pre_ledger(engine):
+    '''
+    make a database imported into by a version without Import_ledger and import_generation
+    '''
+    with engine.begin() as connection:
+        connection.exec_driver_sql('DROP TABLE "Import_ledger"')
+        connection.exec_driver_sql('DROP INDEX "ix_Patient_SV_import_generation"')
+        connection.exec_driver_sql('ALTER TABLE "Patient_SV" DROP COLUMN import_generation')
+
+
+def get_N_carriers(engine):
+    with engine.connect() as connection:
+        return sorted(connection.execute(sa.text('SELECT name, N_carriers FROM SV')).all())
+
+
+def count_patient_SVs(engine):
+    with engine.connect() as connection:
+        rows = connection.execute(sa.text(
+            'SELECT p.name, COUNT(*) FROM Patient_SV s JOIN Patient p ON p.id = s.patient_id GROUP BY p.name'
+        ))
+        return dict(rows.all())
+
+
+def test_skip_patients_of_old_schema(import_config):
+    engine = sa.create_engine(import_config['db'])
+    create_old_schema(engine)
+    import_SV.main(dict(import_config, patients=import_config['patients'].replace('patients.tsv', 'patients_a.tsv')))
+    make_pre_ledger(engine)
+    before = count_patient_SVs(engine)
+    assert sorted(before) == ['P0', 'P1']
+    # patients of the first import count as written, only the others are imported
+    import_SV.main(import_config)
+    after = count_patient_SVs(engine)
+    assert sorted(after) == ['P0', 'P1', 'P2', 'P3']
+    assert {name: after[name] for name in before} == before
+    with engine.connect() as connection:
+        assert connection.execute(sa.text('SELECT COUNT(*) FROM Patient')).scalar() == 4
+        assert connection.execute(sa.text('SELECT COUNT(*) FROM Patient_HPO')).scalar() == 2
+        stages = connection.execute(sa.text("SELECT name, stage FROM Import_ledger WHERE kind = 'patient'")).all()
+    assert sorted(stages) == [(f'P{n}', 'written') for n in range(4)]
+
+
+def test_resume_on_old_schema(import_config, monkeypatch):
+    engine = sa.create_engine(import_config['db'])
+    create_old_schema(engine)
+    write_patient = import_SV.write_patient
+    written = []
+    def crash(*args, **kwargs):
+        if len(written) == 2:
+            raise RuntimeError('interrupted')
+        write_patient(*args, **kwargs)
+        written.append(args[1]['name'])
+    monkeypatch.setattr(import_SV, 'write_patient', crash)
+    try:
+        import_SV.main(import_config)
+    except RuntimeError:
+        pass
+    # the connection of the interrupted import would hold its lock until the process exits
+    sa.orm.close_all_sessions()
+    monkeypatch.setattr(import_SV, 'write_patient', write_patient)
+    assert sorted(count_patient_SVs(engine)) == written
+    import_SV.main(import_config)
+    resumed = count_patient_SVs(engine)
+    fresh_config = dict(import_config, db=import_config['db'].replace('svrare.sqlite', 'fresh.sqlite'))
+    import_SV.main(fresh_config)
+    fresh_engine = sa.create_engine(fresh_config['db'])
+    assert resumed == count_patient_SVs(fresh_engine)
+    assert get_N_carriers(engine) == get_N_carriers(fresh_engine)
+    with engine.connect() as connection:
+        runs = connection.execute(sa.text("SELECT generation, stage FROM Import_ledger WHERE kind = 'run'")).all()
+        generations = connection.execute(sa.text('SELECT DISTINCT import_generation FROM Patient_SV')).scalars().all()
+    assert runs == [(1, 'done')]
+    assert generations == [1]